@@ -0,0 +1,172 @@
+"""
+複数の被験者(データディレクトリ)に対して、血流・脳波の解析をまとめて実行する
+
+実行条件---
+解析するデータディレクトリがdata/以下にあること
+血流解析はsummary.xlsxのanalyze_infoシートの記入が済んでいること
+
+実行方法---
+python batch_analyze.py 20230613_tohma 20230614_*
+python batch_analyze.py "2023*" --jobs 4 --steps blood eeg
+データディレクトリ名はglobのパターンで指定できる。指定しない場合はdata/以下のすべてを対象とする
+--jobsで指定した数の被験者を並列に処理し、最後に処理時間の一覧を表示する
+
+出力---
+各スクリプトを単体で実行した場合と同じ出力に加え、
+脳波の加算結果はグラフを表示せずにeeg_csv/eeg_add.pngとして保存する
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+
+matplotlib.use("Agg")  # 並列実行中にグラフのウィンドウを開かない
+
+import pandas as pd
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURRENT_DIR, "blood_analyze"))
+sys.path.append(os.path.join(CURRENT_DIR, "eeg_analyze"))
+
+import create_analyze_info_check
+import detect_analyze_info
+import make_summary_data
+import make_blood_outputs
+import artifact_remove
+import eeg_add
+
+# 解析の段階ごとに、実行するスクリプトと必要なディレクトリ
+STEPS = {
+    "check": ("blood_csv", [create_analyze_info_check]),
+    "detect": ("blood_csv", [detect_analyze_info]),
+    "blood": ("blood_csv", [make_summary_data, make_blood_outputs]),
+    "eeg": ("eeg_csv", [artifact_remove, eeg_add]),
+}
+
+
+def find_data_dir_names(patterns):
+    """
+    data/以下から、パターンに一致するデータディレクトリ名のリストを返します。
+
+    Args:
+        patterns (List[str]): データディレクトリ名またはglobのパターンのリスト。
+
+    Returns:
+        List[str]: データディレクトリ名のリスト。
+    """
+    data_root = create_analyze_info_check.get_data_dir_path("")
+    data_dir_names = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.join(data_root, pattern))):
+            name = os.path.basename(path)
+            if os.path.isdir(path) and name not in data_dir_names:
+                data_dir_names.append(name)
+
+    return data_dir_names
+
+
+def run_subject(data_dir_name, steps):
+    """
+    1人分のデータディレクトリに対して、指定された段階のスクリプトを順に実行します。
+
+    Args:
+        data_dir_name (str): データディレクトリ名。
+        steps (List[str]): 実行する段階("check", "detect", "blood", "eeg")のリスト。
+
+    各スクリプトのmainは成功するとTrue、入力の不足などで何もしなかった場合はFalseを返します。
+
+    Returns:
+        List[dict]: スクリプトごとの実行結果(データ名、スクリプト名、処理時間、結果)。
+    """
+    data_dir_path = create_analyze_info_check.get_data_dir_path(data_dir_name)
+    results = []
+    for step in steps:
+        csv_dir_name, modules = STEPS[step]
+        if not os.path.isdir(os.path.join(data_dir_path, csv_dir_name)):
+            continue
+
+        for module in modules:
+            if module is artifact_remove and eeg_add.REJECT_EPOCHS:
+                # エポック除外モードではartifact_removedのcsvを使わない
+                continue
+
+            start = time.perf_counter()
+            try:
+                if module is eeg_add:
+                    graph_path = os.path.join(data_dir_path, "eeg_csv", "eeg_add.png")
+                    succeeded = module.main(
+                        data_dir_name=data_dir_name, graph_path=graph_path
+                    )
+                else:
+                    succeeded = module.main(data_dir_name=data_dir_name)
+                status = "ok" if succeeded else "failed"
+            except Exception as e:
+                status = f"error: {e}"
+            results.append(
+                {
+                    "data": data_dir_name,
+                    "script": module.__name__,
+                    "seconds": round(time.perf_counter() - start, 2),
+                    "status": status,
+                }
+            )
+            if status != "ok":
+                # 前のスクリプトが失敗した場合、古い出力を使わないように後続の段階も実行しない
+                return results
+
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "data_dirs",
+        nargs="*",
+        default=["*"],
+        help="data/以下のデータディレクトリ名(globのパターン可)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="並列に処理する被験者数(プロセス数)"
+    )
+    parser.add_argument(
+        "--steps",
+        nargs="+",
+        choices=list(STEPS),
+        default=["blood", "eeg"],
+        help="実行する解析の段階",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    data_dir_names = find_data_dir_names(args.data_dirs)
+    if not data_dir_names:
+        print("指定されたデータディレクトリが見つかりません")
+        return
+
+    start = time.perf_counter()
+    steps_list = [args.steps] * len(data_dir_names)
+    if args.jobs <= 1:
+        subject_results = list(map(run_subject, data_dir_names, steps_list))
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            subject_results = list(
+                executor.map(run_subject, data_dir_names, steps_list)
+            )
+
+    results = [result for results in subject_results for result in results]
+    if results:
+        print(pd.DataFrame(results).to_string(index=False))
+    print("被験者数：", len(data_dir_names))
+    print("合計処理時間：", round(time.perf_counter() - start, 2), "秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,6 @@ summary.xlsxのanalyze_infoシートの記入とdataシートの生成が済ん
 """
 
 import pandas as pd
-import math
-from scipy.interpolate import Akima1DInterpolator
 import numpy as np
 import openpyxl
 from openpyxl.chart import LineChart, Reference
@@ -20,18 +18,25 @@ from openpyxl.utils.dataframe import dataframe_to_rows
 
 from create_analyze_info_check import (
     get_setting_file_path,
-    get_data_dir_path,
     read_dir_name_from_settings,
 )
-
-DEVIATION_IN_ONE_CYCLE = 0.014285714
-CIRCLE_PERIOD = 3
-CIRCLE_HIDE = 2.7
+from blood_pipeline import (
+    BloodPipeline,
+    SAMPLING_PERIOD,
+    WINDOW_SIZE,
+    write_excel_sheets,
+)
+from blood_cache import (
+    hash_values,
+    read_stage_keys,
+    write_stage_keys,
+)
 
 ADD_RANGE = 3
 POINT = 1000
 
-WINDOW_SIZE = 3
+
+STAGE_NAME = "analyze_blood"
 
 
 def read_directory_path_from_settings(file_name):
@@ -53,133 +58,6 @@ def read_directory_path_from_settings(file_name):
     return None
 
 
-def get_deviation(analyze_info):
-    """
-    Analyze_infoデータフレームからズレ(deviation)のリストを取得します。
-
-    Args:
-        analyze_info (DataFrame): 分析情報が含まれるPandasのデータフレーム。
-
-    Returns:
-        List[float]: 分析情報から読み取ったズレのリスト。
-    """
-    deviation = (
-        analyze_info[analyze_info[0] == "deviation"].iloc[0, 1:].dropna().tolist()
-    )
-
-    return deviation
-
-
-def get_target_numbers(analyze_info):
-    """
-    Analyze_infoデータフレームから目標値(target number)のリストを取得します。
-
-    Args:
-        analyze_info (DataFrame): 分析情報が含まれるPandasのデータフレーム。
-
-    Returns:
-        List[List[float]]: 目標値のリストのリスト。各サブリストは一つの実験データに対応します。
-    """
-    target_rows = analyze_info[analyze_info[0].str.contains("target number")]
-    target_numbers = target_rows.iloc[:, 1:].values.tolist()
-
-    for i in range(len(target_numbers)):
-        target_numbers[i] = [num for num in target_numbers[i]]
-
-    target_numbers = [list(row) for row in zip(*target_numbers)]
-
-    target_numbers = [
-        [x for x in sublist if not math.isnan(x)] for sublist in target_numbers
-    ]
-
-    return target_numbers
-
-
-def load_sheets(file_path):
-    """
-    指定されたエクセルファイルから必要なシートを読み込み、データフレームの辞書として返します。
-
-    Args:
-        file_path (str): エクセルファイルのパス。
-
-    Returns:
-        dict: キーがシート名、値が対応するデータフレームの辞書。
-    """
-    # エクセルファイルを読み込む
-    excel_file = pd.ExcelFile(file_path)
-
-    # エクセルファイルのすべてのシート名を取得する
-    sheet_names = excel_file.sheet_names
-
-    # ロードしたくないシートをフィルタリングする
-    # analyze_info'を無視し、CH7からCH16のシートをロードしたい。
-    filtered_sheets = [
-        name
-        for name in sheet_names
-        if name not in ["analyze_info"] and name.startswith("CH")
-    ]
-
-    # 必要なシートをデータフレームの辞書に読み込む
-    dataframes = {}
-    for sheet_name in filtered_sheets:
-        df = pd.read_excel(file_path, sheet_name=sheet_name, header=None)
-        df.columns = [
-            f"data{i+1}" for i in range(len(df.columns))
-        ]  # 列名を指定(data1,data2,...)
-        dataframes[sheet_name] = df
-
-    return dataframes
-
-
-def apply_moving_average(dataframes, window_size=WINDOW_SIZE):
-    """
-    各データフレーム内の全ての列に移動平均を適用します。
-
-    Args:
-        dataframes (dict): データフレームの辞書。
-        window_size (int): 移動平均ウィンドウのサイズ。
-
-    Returns:
-        dict: 各列に移動平均を適用したデータフレームの辞書。
-    """
-    ma_dataframes = {}
-    for sheet_name, df in dataframes.items():
-        ma_df = df.rolling(window=window_size, min_periods=1).mean()
-        ma_dataframes[sheet_name] = ma_df
-
-    return ma_dataframes
-
-
-def apply_akima_interpolation(dataframes):
-    """
-    各データフレームの全ての列に秋間補間を適用します。
-
-    Args:
-        dataframes (dict): データフレームの辞書。
-
-    Returns:
-        dict: 各サブ辞書には、データフレームの各列に対する秋間補間子が含まれる辞書。
-    """
-    akima_interpolators = {}
-    for sheet_name, df in dataframes.items():
-        interpolators = {}
-        for column in df.columns:
-            # NaN値を持つ列の処理
-            mask = ~np.isnan(df[column])
-            if mask.sum() < 2:
-                # 補間するのに十分なデータポイントがない
-                interpolator = None
-            else:
-                # カラム用の秋間インターポレーターを作成する。
-                x_axis = [round((i * 0.2), 1) for i in range(len(df[column][mask]))]
-                # print(x_axis) DEBUG
-                interpolator = Akima1DInterpolator(x_axis, df[column][mask])
-            interpolators[column] = interpolator
-        akima_interpolators[sheet_name] = interpolators
-
-    return akima_interpolators
-
-
 def plot_series(series):
     """
     DEBUG用
@@ -215,149 +93,117 @@ def plot_akima_interpolation(akima_interp):
     plt.show()
 
 
-def target_number_to_time(deviation, target_numbers):
+def gather_epochs(interpolator, target_time, offsets):
     """
-    目標値(target number)とズレ(deviation)を時間に変換します。
+    秋間補間オブジェクトの区分多項式から、全ターゲットのエポックをまとめて取り出します。
+    時刻の並び(offsets)は全ターゲットで共通なので、各点が属する区間の番号と区間内の位置を
+    配列演算でまとめて求め、その区間の多項式の係数を集めて評価します。
 
     Args:
-        deviation (List[float]): ズレのリスト。
-        target_numbers (List[List[float]]): 目標値のリスト。
+        interpolator (PPoly): (サンプル数 × チャンネル数)のデータの秋間補間(区分多項式)。
+        target_time (List[float]): ターゲット提示の時刻のリスト。
+        offsets (numpy.ndarray): ターゲット提示の時刻を基準にした、取り出す時刻の並び。
 
     Returns:
-        List[List[float]]: ターゲットの提示時間を表す二次元リスト。
+        numpy.ndarray: (ターゲット数, 時刻の数, チャンネル数)の配列。データの範囲外はnan。
     """
-    target_time = [
-        [target_number * CIRCLE_PERIOD + CIRCLE_HIDE for target_number in sublist]
-        for sublist in target_numbers
-    ]
-
-    target_time = [
-        [
-            target_number + deviation_item * DEVIATION_IN_ONE_CYCLE
-            for target_number in target_time_sublist
-        ]
-        for deviation_item, target_time_sublist in zip(deviation, target_time)
-    ]
-    # DEBUG
-    # print(target_time)
-    # 正しく時間に変換されていました！
+    x_axis = interpolator.x
+    coefficients = interpolator.c  # (多項式の次数+1, 区間数, チャンネル数)
+
+    x = np.asarray(target_time, dtype=float)[:, np.newaxis] + offsets
+    segment = np.floor((x - x_axis[0]) / SAMPLING_PERIOD).astype(int)
+    segment = np.clip(segment, 0, len(x_axis) - 2)
+    dx = (x - x_axis[segment])[..., np.newaxis]
+
+    # ホーナー法で区分多項式を評価する
+    segment_coefficients = coefficients[:, segment]
+    epochs = segment_coefficients[0]
+    for c in segment_coefficients[1:]:
+        epochs = epochs * dx + c
 
-    return target_time
+    out_of_range = (x < x_axis[0]) | (x > x_axis[-1])
+    epochs[out_of_range] = np.nan
 
+    return epochs
 
-def make_target_df(target_time, data_interpolators):
+
+def make_target_df(target_time, data_interpolators, channels):
     """
-    ターゲット付近のデータをまとめたデータフレームを作成します。
+    チャンネルごとに、ターゲット付近のデータをまとめたデータフレームを作成します。
     平均をとった列も作成します。
+    データごとに、全ターゲット・全チャンネル分のエポックをまとめて取り出します。
 
     Args:
         target_time (List[List[float]]): ターゲット提示の時刻をまとめた二次元リスト。
-        data_interpolators (dict): 各チャンネルにおける、各データの補間関数をまとめた辞書。
+        data_interpolators (dict): 各データにおける、チャンネルをまとめた補間関数の辞書。
+        channels (List[str]): 出力するチャンネル名のリスト。
 
     Returns:
-        DataFrame: ターゲット付近のデータをまとめたデータフレーム。
+        dict: キーがチャンネル名、値がターゲット付近のデータをまとめたデータフレームの辞書。
     """
 
-    all_target_Hb = {}
-    keys_ordered = list(data_interpolators.keys())
-
-    for i in range(len(target_time)):
-        for j in range(len(target_time[i])):
-            x = np.linspace(
-                target_time[i][j] - ADD_RANGE,
-                target_time[i][j] + ADD_RANGE,
-                num=POINT,
-            )
-            all_target_Hb[keys_ordered[i] + "target" + str(j + 1)] = data_interpolators[
-                keys_ordered[i]
-            ](x)
-
-    target_df = pd.DataFrame(all_target_Hb)
-    target_df["Average"] = target_df.mean(axis=1)
-
-    return target_df
-
-
-def output_excel_df(result_path, ch, df):
-    # Excelファイルの存在確認と開く
-    if os.path.exists(result_path):
-        book = openpyxl.load_workbook(result_path)
-    else:
-        book = openpyxl.Workbook()
-
-    # シートの処理
-    if ch in book.sheetnames:
-        sheet = book[ch]
-        book.remove(sheet)
-    sheet = book.create_sheet(ch)
-
-    # データフレームの書き込みとフォントの適用
-    yu_gothic_font = Font(name="Yu Gothic")
-    for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), 1):
-        for c_idx, value in enumerate(row, 1):
-            cell = sheet.cell(row=r_idx, column=c_idx)
-            cell.value = value
-            cell.font = yu_gothic_font
-
-    # ファイルの保存前にデフォルトシートを削除
-    if "Sheet" in book.sheetnames and len(book.sheetnames) > 1:
-        std = book["Sheet"]
-        book.remove(std)
-
-    # ファイルの保存
-    book.save(result_path)
-
-
-def main():
-    """
-    プログラムのメイン関数。設定ファイルの読み込み、データ処理、結果のExcel出力を行います。
-    """
-    setting_file = get_setting_file_path()
-    data_dir_name = read_dir_name_from_settings(setting_file)
-    data_dir_path = get_data_dir_path(data_dir_name)
-
-    summary_path = os.path.join(data_dir_path, "blood_excel", "summary.xlsx")
-    result_path = os.path.join(data_dir_path, "blood_excel", "result.xlsx")
-
-    if not os.path.isfile(summary_path):
-        print("blood_excelディレクトリにsummary.xlsxがないです")
-        return
+    all_target_Hb = {ch: {} for ch in channels}
+    offsets = np.linspace(-ADD_RANGE, ADD_RANGE, num=POINT)
 
-    analyze_info = pd.read_excel(
-        summary_path, sheet_name="analyze_info", header=None, engine="openpyxl"
-    )
-
-    deviation = get_deviation(analyze_info)  # 1次元リスト
+    for i, (data_name, interpolators) in enumerate(data_interpolators.items()):
+        if not target_time[i]:
+            continue
+        for interpolator, sheet_names in interpolators:
+            # (ターゲット数, POINT, チャンネル数)の配列
+            target_Hb = gather_epochs(interpolator, target_time[i], offsets)
+            for k, sheet_name in enumerate(sheet_names):
+                for j in range(len(target_time[i])):
+                    target_name = data_name + "target" + str(j + 1)
+                    all_target_Hb[sheet_name][target_name] = target_Hb[j, :, k]
 
-    target_numbers = get_target_numbers(analyze_info)  # 2次元リスト
+    target_dfs = {}
+    for ch in channels:
+        target_df = pd.DataFrame(all_target_Hb[ch])
+        target_df["Average"] = target_df.mean(axis=1)
+        target_dfs[ch] = target_df
 
-    data_dic = load_sheets(summary_path)
+    return target_dfs
 
-    ma_data_dic = apply_moving_average(data_dic)
 
-    # DEBUG
-    # plot_series(ma_data_dic["CH7"]["data1"])
-    # 移動平均は上手く行えていました！
-
-    ch_interpolators_dicdic = apply_akima_interpolation(ma_data_dic)
+def main(data_dir_name=None, pipeline=None):
+    """
+    プログラムのメイン関数。設定ファイルの読み込み、データ処理、結果のExcel出力を行います。
+    pipelineを渡すと、その読み込み・補間の結果を使い回します(make_blood_outputs.py)。
+    """
+    if pipeline is None:
+        # data_dir_nameが指定されていなければanalyze_setting.txtから読み込む
+        if data_dir_name is None:
+            setting_file = get_setting_file_path()
+            data_dir_name = read_dir_name_from_settings(setting_file)
+        pipeline = BloodPipeline(data_dir_name)
+
+    result_path = os.path.join(pipeline.excel_dir_path, "result.xlsx")
+
+    if not pipeline.check():
+        return False
+
+    # データとターゲットの時刻が前回と同じなら、result.xlsxを作り直さない
+    data_dic = pipeline.data_dic
+    target_time = pipeline.target_time
+    stage_keys = read_stage_keys(pipeline.cache_dir_path, STAGE_NAME)
+    result_key = hash_values(
+        *data_dic.values(), list(data_dic), target_time, WINDOW_SIZE, ADD_RANGE, POINT
+    )
+    if stage_keys.get("result") == result_key and os.path.isfile(result_path):
+        print("入力に変更がないため、result.xlsxの作成を省略しました")
+        return True
 
     # DEBUG
-    # plot_akima_interpolation(ch_interpolators["CH7"]["data1"])
+    # plot_akima_interpolation(pipeline.data_interpolators["data1"][0][0])
     # 補間はうまく行えていました！
 
-    if (
-        len(deviation) != len(target_numbers)
-        or len(target_numbers) != len(ch_interpolators_dicdic["CH7"])
-        or len(deviation) != len(ch_interpolators_dicdic["CH7"])
-    ):
-        print("ファイル数やanalyze_infoの内容がおかしい")
-        return
-
-    target_time = target_number_to_time(deviation, target_numbers)
+    ch_target_dfs = make_target_df(
+        target_time, pipeline.data_interpolators, list(pipeline.ma_data_dic)
+    )
 
-    for ch, data_interpolators_dic in ch_interpolators_dicdic.items():
-        ch_target_df = make_target_df(target_time, data_interpolators_dic)
-        output_excel_df(result_path, ch, ch_target_df)
+    write_excel_sheets(result_path, ch_target_dfs)
+    write_stage_keys(pipeline.cache_dir_path, STAGE_NAME, {"result": result_key})
+    return True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+"""
+summary.xlsxのCHシート(CH7~CH16)と同じデータを、blood_cacheディレクトリに.npy形式で保存・読み込みする
+make_summary_data.pyが書き出し、analyze_blood.pyとcreate_data_for_nn.pyはsummary.xlsxより優先して読み込む
+summary.xlsxは確認用の出力として残す
+make_summary_data.pyはsummary.xlsxを書いたときのハッシュ値を記録しておき、summary.xlsxがその後に
+手で編集されたり作り直されたりした(ハッシュ値が違う)場合は、キャッシュを使わずにsummary.xlsxを読む
+
+また、各段階の入力(csvファイルの内容やanalyze_infoのパラメータ)のハッシュ値を段階ごとのjsonに記録し、
+入力が変わっていないセッションや出力ファイルの再計算・再書き込みを省くために使う
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+CACHE_DIR_NAME = "blood_cache"
+
+# キャッシュを書き出す段階(make_summary_data.py)の名前と、
+# その段階の記録で、書き込んだsummary.xlsxのハッシュ値を入れる項目名
+SUMMARY_STAGE_NAME = "make_summary_data"
+SUMMARY_KEY = "summary.xlsx"
+
+
+def get_cache_dir_path(summary_path):
+    """summary.xlsxと同じディレクトリにあるblood_cacheディレクトリのパスを返す"""
+    return os.path.join(os.path.dirname(summary_path), CACHE_DIR_NAME)
+
+
+def write_blood_cache(cache_dir_path, data_dfs):
+    """
+    各チャンネルのデータを1チャンネル1ファイルの.npyとして保存します。
+
+    Args:
+        cache_dir_path (str): blood_cacheディレクトリのパス。
+        data_dfs (dict): キーがチャンネル名(CH7など)、値がデータフレームの辞書。
+    """
+    if not os.path.isdir(cache_dir_path):
+        os.makedirs(cache_dir_path)
+
+    for ch, df in data_dfs.items():
+        np.save(os.path.join(cache_dir_path, ch + ".npy"), df.to_numpy(dtype=float))
+
+
+def read_blood_cache(cache_dir_path, summary_path=None):
+    """
+    blood_cacheディレクトリからCHシートと同じ形のデータフレームの辞書を読み込みます。
+
+    Args:
+        cache_dir_path (str): blood_cacheディレクトリのパス。
+        summary_path (str): 指定すると、このsummary.xlsxがmake_summary_data.pyの書いたときのままの
+                            場合だけキャッシュを読み込みます。
+
+    Returns:
+        dict: キーがチャンネル名、値がデータフレーム(列名はdata1,data2,...)の辞書。
+              キャッシュが無い場合や、summary.xlsxと合わない場合はNoneを返します。
+    """
+    if not os.path.isdir(cache_dir_path):
+        return None
+
+    if summary_path is not None:
+        summary_keys = read_stage_keys(cache_dir_path, SUMMARY_STAGE_NAME)
+        if not os.path.isfile(summary_path) or summary_keys.get(
+            SUMMARY_KEY
+        ) != hash_file(summary_path):
+            return None
+
+    channels = [
+        f.rsplit(".", 1)[0]
+        for f in os.listdir(cache_dir_path)
+        if f.startswith("CH") and f.endswith(".npy")
+    ]
+    if not channels:
+        return None
+
+    # summary.xlsxのシート順(CH7, CH8, ..., CH16)に合わせる
+    channels.sort(key=lambda ch: int(ch[2:]))
+
+    dataframes = {}
+    for ch in channels:
+        data = np.load(os.path.join(cache_dir_path, ch + ".npy"), mmap_mode="r")
+        dataframes[ch] = pd.DataFrame(
+            data, columns=[f"data{i+1}" for i in range(data.shape[1])]
+        )
+
+    return dataframes
+
+
+def hash_file(file_path):
+    """ファイルの内容のハッシュ値を返す"""
+    file_hash = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def hash_values(*values):
+    """
+    配列やパラメータをまとめたハッシュ値を返します。
+
+    Args:
+        values: numpy配列、データフレーム、またはreprで区別できる値(数値、文字列、リストなど)。
+
+    Returns:
+        str: ハッシュ値。
+    """
+    values_hash = hashlib.sha1()
+    for value in values:
+        if isinstance(value, (np.ndarray, pd.DataFrame, pd.Series)):
+            array = np.ascontiguousarray(np.asarray(value, dtype=float))
+            values_hash.update(repr(array.shape).encode())
+            values_hash.update(array.tobytes())
+        else:
+            values_hash.update(repr(value).encode())
+        values_hash.update(b"|")
+    return values_hash.hexdigest()
+
+
+def read_stage_keys(cache_dir_path, stage):
+    """
+    段階(stage)ごとに記録した、前回の入力のハッシュ値を読み込みます。
+
+    Args:
+        cache_dir_path (str): blood_cacheディレクトリのパス。
+        stage (str): 段階の名前(スクリプト名など)。
+
+    Returns:
+        dict: キーが項目名(セッションや出力ファイル)、値がハッシュ値の辞書。記録が無ければ空の辞書。
+    """
+    keys_path = os.path.join(cache_dir_path, stage + "_keys.json")
+    if not os.path.isfile(keys_path):
+        return {}
+
+    with open(keys_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_stage_keys(cache_dir_path, stage, stage_keys):
+    """段階(stage)ごとの入力のハッシュ値を記録します。"""
+    if not os.path.isdir(cache_dir_path):
+        os.makedirs(cache_dir_path)
+
+    keys_path = os.path.join(cache_dir_path, stage + "_keys.json")
+    with open(keys_path, "w", encoding="utf-8") as file:
+        json.dump(stage_keys, file, ensure_ascii=False, indent=2)
+
+
+def read_stage_array(cache_dir_path, stage, name):
+    """段階(stage)ごとに保存した配列を読み込みます。無ければNoneを返します。"""
+    array_path = os.path.join(cache_dir_path, stage, name + ".npy")
+    if not os.path.isfile(array_path):
+        return None
+    return np.load(array_path)
+
+
+def write_stage_array(cache_dir_path, stage, name, array):
+    """段階(stage)ごとに配列を保存します。"""
+    stage_dir_path = os.path.join(cache_dir_path, stage)
+    if not os.path.isdir(stage_dir_path):
+        os.makedirs(stage_dir_path)
+    np.save(os.path.join(stage_dir_path, name + ".npy"), array)
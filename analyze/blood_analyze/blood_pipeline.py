@@ -0,0 +1,313 @@
+"""
+analyze_blood.pyとcreate_data_for_nn.py(eeg_add.pyのターゲット番号の読み込みも)で共通の処理をまとめたモジュール
+
+summary.xlsxの読み込み → 移動平均 → 秋間補間 の途中結果をBloodPipelineが保持し、
+各段階は最初に参照されたときに一度だけ計算する
+同じBloodPipelineを両スクリプトのmainに渡すと、読み込みと補間が一度で済む(make_blood_outputs.py)
+"""
+
+import math
+import os
+from functools import cached_property
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, NamedStyle
+from openpyxl.utils.dataframe import dataframe_to_rows
+from scipy.interpolate import Akima1DInterpolator, PPoly
+
+from create_analyze_info_check import get_data_dir_path
+from blood_cache import get_cache_dir_path, read_blood_cache
+
+DEVIATION_IN_ONE_CYCLE = 0.014285714
+CIRCLE_PERIOD = 3
+CIRCLE_HIDE = 2.7
+
+WINDOW_SIZE = 3
+
+SAMPLING_PERIOD = 0.2  # 血流データのサンプリング周期[s]
+
+FONT_STYLE_NAME = "yu_gothic"
+
+
+def read_analyze_info(summary_path):
+    """summary.xlsxのanalyze_infoシートをヘッダーなしのデータフレームとして読み込む"""
+    return pd.read_excel(
+        summary_path, sheet_name="analyze_info", header=None, engine="openpyxl"
+    )
+
+
+def get_deviation(analyze_info):
+    """
+    Analyze_infoデータフレームからズレ(deviation)のリストを取得します。
+
+    Args:
+        analyze_info (DataFrame): 分析情報が含まれるPandasのデータフレーム。
+
+    Returns:
+        List[float]: 分析情報から読み取ったズレのリスト。
+    """
+    deviation = (
+        analyze_info[analyze_info[0] == "deviation"].iloc[0, 1:].dropna().tolist()
+    )
+
+    return deviation
+
+
+def get_target_numbers(analyze_info):
+    """
+    Analyze_infoデータフレームから目標値(target number)のリストを取得します。
+
+    Args:
+        analyze_info (DataFrame): 分析情報が含まれるPandasのデータフレーム。
+
+    Returns:
+        List[List[float]]: 目標値のリストのリスト。各サブリストは一つの実験データに対応します。
+    """
+    target_rows = analyze_info[analyze_info[0].str.contains("target number")]
+    target_numbers = target_rows.iloc[:, 1:].values.tolist()
+
+    for i in range(len(target_numbers)):
+        target_numbers[i] = [num for num in target_numbers[i]]
+
+    target_numbers = [list(row) for row in zip(*target_numbers)]
+
+    target_numbers = [
+        [x for x in sublist if not math.isnan(x)] for sublist in target_numbers
+    ]
+
+    return target_numbers
+
+
+def load_sheets(file_path):
+    """
+    指定されたエクセルファイルから必要なシートを読み込み、データフレームの辞書として返します。
+    ファイルは一度だけ開き、analyze_infoとCHシートをまとめて解析します。
+
+    Args:
+        file_path (str): エクセルファイルのパス。
+
+    Returns:
+        tuple: (analyze_infoのデータフレーム, キーがシート名、値が対応するデータフレームの辞書)。
+    """
+    with pd.ExcelFile(file_path, engine="openpyxl") as excel_file:
+        # analyze_infoとCH7からCH16のシートだけを読み込む
+        filtered_sheets = [
+            name
+            for name in excel_file.sheet_names
+            if name == "analyze_info" or name.startswith("CH")
+        ]
+        sheets = excel_file.parse(sheet_name=filtered_sheets, header=None)
+
+    analyze_info = sheets.pop("analyze_info", None)
+
+    dataframes = {}
+    for sheet_name, df in sheets.items():
+        df.columns = [
+            f"data{i+1}" for i in range(len(df.columns))
+        ]  # 列名を指定(data1,data2,...)
+        dataframes[sheet_name] = df
+
+    return analyze_info, dataframes
+
+
+def apply_moving_average(dataframes, window_size=WINDOW_SIZE):
+    """
+    各データフレーム内の全ての列に移動平均を適用します。
+
+    Args:
+        dataframes (dict): データフレームの辞書。
+        window_size (int): 移動平均ウィンドウのサイズ。
+
+    Returns:
+        dict: 各列に移動平均を適用したデータフレームの辞書。
+    """
+    ma_dataframes = {}
+    for sheet_name, df in dataframes.items():
+        ma_df = df.rolling(window=window_size, min_periods=1).mean()
+        ma_dataframes[sheet_name] = ma_df
+
+    return ma_dataframes
+
+
+def apply_akima_interpolation(dataframes):
+    """
+    全チャンネルのデータフレームの全ての列に秋間補間を適用します。
+    秋間補間はチャンネルごとに作り(scipyは傾きがほぼ0かどうかのしきい値を渡した配列全体から
+    決めるので、2次元配列をまとめて補間するとチャンネルごとの値とわずかに変わる)、
+    同じ列(データ)で有効なデータ数が等しいチャンネルの係数を一つの区分多項式にまとめます。
+    まとめた区分多項式の値は、チャンネルごとの秋間補間の値と完全に一致します。
+
+    Args:
+        dataframes (dict): キーがチャンネル名、値がデータフレームの辞書。
+
+    Returns:
+        dict: キーが列名(data1など)、値が(秋間補間オブジェクト, チャンネル名のリスト)のリストの辞書。
+              補間オブジェクト(PPoly)に時刻の配列を渡すと、(時刻の数 × チャンネル数)の配列が返ります。
+    """
+    akima_interpolators = {}
+    columns = next(iter(dataframes.values())).columns
+    for column in columns:
+        # NaN値を除いたデータ数ごとにチャンネルをまとめる
+        sheet_names_by_length = {}
+        for sheet_name, df in dataframes.items():
+            data_length = int(df[column].count())
+            sheet_names_by_length.setdefault(data_length, []).append(sheet_name)
+
+        interpolators = []
+        for data_length, sheet_names in sheet_names_by_length.items():
+            if data_length < 2:
+                # 補間するのに十分なデータポイントがない
+                continue
+            x_axis = np.round(np.arange(data_length) * SAMPLING_PERIOD, 1)
+            channel_interpolators = [
+                Akima1DInterpolator(x_axis, dataframes[sheet_name][column].dropna())
+                for sheet_name in sheet_names
+            ]
+            # 係数を(多項式の次数+1, 区間数, チャンネル数)に並べる
+            coefficients = np.stack(
+                [interpolator.c for interpolator in channel_interpolators], axis=-1
+            )
+            interpolator = PPoly.construct_fast(
+                coefficients, x_axis, extrapolate=channel_interpolators[0].extrapolate
+            )
+            interpolators.append((interpolator, sheet_names))
+        akima_interpolators[column] = interpolators
+
+    return akima_interpolators
+
+
+def target_number_to_time(deviation, target_numbers):
+    """
+    目標値(target number)とズレ(deviation)を時間に変換します。
+
+    Args:
+        deviation (List[float]): ズレのリスト。
+        target_numbers (List[List[float]]): 目標値のリスト。
+
+    Returns:
+        List[List[float]]: ターゲットの提示時間を表す二次元リスト。
+    """
+    target_time = [
+        [target_number * CIRCLE_PERIOD + CIRCLE_HIDE for target_number in sublist]
+        for sublist in target_numbers
+    ]
+
+    target_time = [
+        [
+            target_number + deviation_item * DEVIATION_IN_ONE_CYCLE
+            for target_number in target_time_sublist
+        ]
+        for deviation_item, target_time_sublist in zip(deviation, target_time)
+    ]
+
+    return target_time
+
+
+def write_excel_sheets(excel_path, dataframes):
+    """
+    データフレームをシートごとにエクセルファイルへ一度にまとめて書き込みます(result.xlsxとnn_data.xlsx)。
+    書き込み専用モードでシートを順に流し込み、フォントは名前付きスタイルとして一度だけ登録します。
+
+    Args:
+        excel_path (str): 書き込むエクセルファイルのパス。
+        dataframes (dict): キーがシート名、値が書き込むデータフレームの辞書。
+    """
+    book = openpyxl.Workbook(write_only=True)
+    book.add_named_style(NamedStyle(name=FONT_STYLE_NAME, font=Font(name="Yu Gothic")))
+
+    for sheet_name, df in dataframes.items():
+        sheet = book.create_sheet(sheet_name)
+        for row in dataframe_to_rows(df, index=False, header=True):
+            cells = []
+            for value in row:
+                cell = WriteOnlyCell(sheet, value=value)
+                cell.style = FONT_STYLE_NAME
+                cells.append(cell)
+            sheet.append(cells)
+
+    # ファイルの保存
+    book.save(excel_path)
+
+
+class BloodPipeline:
+    """
+    1人分のデータディレクトリについて、summary.xlsxの読み込みから秋間補間までの途中結果を保持します。
+    各段階はプロパティとして最初に参照されたときに一度だけ計算されます。
+
+    Args:
+        data_dir_name (str): data/以下のデータディレクトリ名。
+    """
+
+    def __init__(self, data_dir_name):
+        self.data_dir_name = data_dir_name
+        self.data_dir_path = get_data_dir_path(data_dir_name)
+        self.excel_dir_path = os.path.join(self.data_dir_path, "blood_excel")
+        self.summary_path = os.path.join(self.excel_dir_path, "summary.xlsx")
+        self.cache_dir_path = get_cache_dir_path(self.summary_path)
+
+    @cached_property
+    def cached_data_dic(self):
+        # make_summary_data.pyが書き出したキャッシュ。無いか、summary.xlsxがその後に変わっていればNone
+        return read_blood_cache(self.cache_dir_path, self.summary_path)
+
+    @cached_property
+    def summary_sheets(self):
+        # キャッシュが無いときは、summary.xlsxを一度だけ開いて全シートをまとめて読み込む
+        return load_sheets(self.summary_path)
+
+    @cached_property
+    def analyze_info(self):
+        if self.cached_data_dic is None:
+            return self.summary_sheets[0]
+        return read_analyze_info(self.summary_path)
+
+    @cached_property
+    def deviation(self):
+        return get_deviation(self.analyze_info)  # 1次元リスト
+
+    @cached_property
+    def target_numbers(self):
+        return get_target_numbers(self.analyze_info)  # 2次元リスト
+
+    @cached_property
+    def target_time(self):
+        return target_number_to_time(self.deviation, self.target_numbers)
+
+    @cached_property
+    def data_dic(self):
+        # make_summary_data.pyが書き出したキャッシュがあれば、summary.xlsxの再解析を省く
+        if self.cached_data_dic is None:
+            return self.summary_sheets[1]
+        return self.cached_data_dic
+
+    @cached_property
+    def ma_data_dic(self):
+        return apply_moving_average(self.data_dic)
+
+    @cached_property
+    def data_interpolators(self):
+        return apply_akima_interpolation(self.ma_data_dic)
+
+    def check(self):
+        """
+        summary.xlsxがあり、analyze_infoとデータの数が合っているかを確認します。
+        問題があればメッセージを表示してFalseを返します。
+        """
+        if not os.path.isfile(self.summary_path):
+            print("blood_excelディレクトリにsummary.xlsxがないです")
+            return False
+
+        # 補間オブジェクトの辞書はデータ(列)ごとに作られるので、補間する前に列の数で確かめる
+        data_number = len(next(iter(self.data_dic.values())).columns)
+        if (
+            len(self.deviation) != len(self.target_numbers)
+            or len(self.target_numbers) != data_number
+            or len(self.deviation) != data_number
+        ):
+            print("ファイル数やanalyze_infoの内容がおかしい")
+            return False
+
+        return True
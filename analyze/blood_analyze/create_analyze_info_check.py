@@ -1,19 +1,41 @@
 """
 deviation(ずれ)と、外乱の終了点を確認するためのcreate_analyze_info_check.xlsxを作成する
 作成されたを参考に、summary.xlsxのanalyze_infoシートを作成する
+OUTPUT_FORMATSに"html"や"png"を指定すると、1ファイルの全チャンネルを1枚にまとめたグラフも作成する
 """
 
+import base64
+import html
+import io
 import os
+import numpy as np
 import pandas as pd
 import openpyxl
+from matplotlib.figure import Figure
 from openpyxl.chart import LineChart, Reference
 from openpyxl.styles import Font
 
+from blood_cache import (
+    CACHE_DIR_NAME,
+    hash_file,
+    hash_values,
+    read_stage_keys,
+    write_stage_keys,
+)
+
 SKIP_ROWS_NUMBER = 54
 DISPLAY_DATA_RANGE = 280
+CHANNELS = range(7, 17)
+
+# 出力形式 "xlsx"(analyze_info_check.xlsx), "html"(analyze_info_check.html),
+# "png"(analyze_info_checkディレクトリにファイルごと) から選ぶ
+OUTPUT_FORMATS = ["xlsx"]
+PREVIEW_DPI = 60
 
 file_counter = 1
 
+STAGE_NAME = "create_analyze_info_check"
+
 
 def get_setting_file_path():
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -48,15 +70,31 @@ def read_dir_name_from_settings(file_name):
     return None
 
 
-def create_graph_from_csv(csv_path, ch_col, wb, i):
-    global file_counter
+def read_preview_data(csv_path):
+    """
+    csvファイルを一度だけ読み込み、グラフに使う先頭DISPLAY_DATA_RANGE行の全チャンネルを返す
+
+    Args:
+        csv_path (str): csvファイルのパス。
 
+    Returns:
+        DataFrame: 列名がチャンネル番号(7~16)のデータフレーム。
+    """
     df = pd.read_csv(
-        csv_path, encoding="Shift-JIS", skiprows=range(0, SKIP_ROWS_NUMBER)
+        csv_path,
+        encoding="Shift-JIS",
+        skiprows=SKIP_ROWS_NUMBER,
+        nrows=DISPLAY_DATA_RANGE,
+        usecols=list(CHANNELS),
+        header=0,
     )
+    df.columns = list(CHANNELS)
+
+    return df
 
-    start_col = ord(ch_col) - ord("A")
-    y_values = df.iloc[:DISPLAY_DATA_RANGE, start_col].values
+
+def create_graph_from_csv(csv_path, y_values, wb, i):
+    global file_counter
 
     sheet_title = os.path.basename(csv_path).split(".")[0]
 
@@ -88,9 +126,77 @@ def create_graph_from_csv(csv_path, ch_col, wb, i):
     ws.add_chart(chart, "E5")
 
 
-def main():
-    setting_file = get_setting_file_path()
-    data_dir_name = read_dir_name_from_settings(setting_file)
+def create_preview_png(csv_path, df):
+    """
+    1ファイル分の全チャンネルのグラフを1枚の画像にまとめる
+    pyplotを使わずにFigureを直接作るので、画面の無い環境でも動作する
+
+    Args:
+        csv_path (str): csvファイルのパス(タイトルに使う)。
+        df (DataFrame): read_preview_dataで読み込んだデータ。
+
+    Returns:
+        bytes: PNG画像のバイト列。
+    """
+    fig = Figure(figsize=(20, 7), dpi=PREVIEW_DPI)
+    axes = fig.subplots(2, 5, sharex=True)
+
+    # エクセルの行番号と同じく1から数える
+    x = np.arange(1, len(df) + 1)
+    for ax, ch in zip(axes.flat, CHANNELS):
+        ax.plot(x, df[ch].values, linewidth=1)
+        ax.set_title(f"CH{ch}")
+        ax.grid(True)
+
+    fig.suptitle(os.path.basename(csv_path))
+    # tight_layoutは描画1回分の時間がかかるため、余白は固定で指定する
+    fig.subplots_adjust(
+        left=0.03, right=0.99, bottom=0.05, top=0.88, wspace=0.2, hspace=0.3
+    )
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+
+    return buffer.getvalue()
+
+
+def write_preview_files(preview_dir, preview_pngs):
+    """ファイルごとのグラフ(create_preview_pngの画像)をpreview_dirにPNGで保存する"""
+    if not os.path.isdir(preview_dir):
+        os.makedirs(preview_dir)
+
+    for csv_path, png in sorted(preview_pngs.items()):
+        file_name = os.path.basename(csv_path).rsplit(".", 1)[0] + ".png"
+        with open(os.path.join(preview_dir, file_name), "wb") as file:
+            file.write(png)
+
+
+def write_preview_html(html_path, preview_pngs):
+    """ファイルごとのグラフの画像を埋め込んだ、1ファイルで完結するHTMLを作成する"""
+    sections = []
+    for csv_path, png in sorted(preview_pngs.items()):
+        name = html.escape(os.path.basename(csv_path))
+        png = base64.b64encode(png).decode("ascii")
+        sections.append(
+            f"<h2>{name}</h2>\n"
+            f'<img src="data:image/png;base64,{png}" alt="{name}" loading="lazy">'
+        )
+
+    with open(html_path, "w", encoding="utf-8") as file:
+        file.write(
+            '<!DOCTYPE html>\n<html lang="ja">\n<head>\n<meta charset="utf-8">\n'
+            "<title>analyze_info_check</title>\n"
+            "<style>img { max-width: 100%; }</style>\n</head>\n<body>\n"
+            + "\n".join(sections)
+            + "\n</body>\n</html>\n"
+        )
+
+
+def main(data_dir_name=None):
+    # data_dir_nameが指定されていなければanalyze_setting.txtから読み込む
+    if data_dir_name is None:
+        setting_file = get_setting_file_path()
+        data_dir_name = read_dir_name_from_settings(setting_file)
 
     data_dir_path = get_data_dir_path(data_dir_name)
 
@@ -102,23 +208,68 @@ def main():
         print("blood_excelディレクトリを作成しました。")
 
     output_excel_path = os.path.join(excel_directory, "analyze_info_check.xlsx")
-
-    wb = openpyxl.Workbook()
-    wb.remove(wb.active)  # デフォルトのシートを削除
-
-    # 指定したディレクトリ内のCSVファイルすべてを処理
-    for i in range(7, 17):
-        global file_counter
-        file_counter = 1
-        ch_col = number_to_alphabet(int(i))
-        for csv_file in os.listdir(csv_directory):
-            if csv_file.endswith(".csv"):
-                create_graph_from_csv(
-                    os.path.join(csv_directory, csv_file), ch_col, wb, i
-                )
-
-    wb.save(output_excel_path)
-    print("エクセルファイルにグラフを保存しました。")
+    output_html_path = os.path.join(excel_directory, "analyze_info_check.html")
+    preview_dir = os.path.join(excel_directory, "analyze_info_check")
+    output_paths = {
+        "xlsx": output_excel_path,
+        "html": output_html_path,
+        "png": preview_dir,
+    }
+
+    # csvファイルの内容が前回と同じなら作り直さない
+    cache_dir_path = os.path.join(excel_directory, CACHE_DIR_NAME)
+    csv_files = sorted(f for f in os.listdir(csv_directory) if f.endswith(".csv"))
+    check_key = hash_values(
+        [(f, hash_file(os.path.join(csv_directory, f))) for f in csv_files],
+        SKIP_ROWS_NUMBER,
+        DISPLAY_DATA_RANGE,
+        OUTPUT_FORMATS,
+    )
+    stage_keys = read_stage_keys(cache_dir_path, STAGE_NAME)
+    if stage_keys.get("check") == check_key and all(
+        os.path.exists(output_paths[f]) for f in OUTPUT_FORMATS
+    ):
+        print("csvファイルに変更がないため、グラフの作成を省略しました")
+        return True
+
+    # 指定したディレクトリ内のCSVファイルすべてを、1ファイルにつき1回だけ読み込む
+    csv_paths = [
+        os.path.join(csv_directory, csv_file)
+        for csv_file in os.listdir(csv_directory)
+        if csv_file.endswith(".csv")
+    ]
+    preview_data = {csv_path: read_preview_data(csv_path) for csv_path in csv_paths}
+
+    if "xlsx" in OUTPUT_FORMATS:
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active)  # デフォルトのシートを削除
+
+        for i in CHANNELS:
+            global file_counter
+            file_counter = 1
+            for csv_path in csv_paths:
+                create_graph_from_csv(csv_path, preview_data[csv_path][i].values, wb, i)
+
+        wb.save(output_excel_path)
+        print("エクセルファイルにグラフを保存しました。")
+
+    # グラフの画像はhtmlとpngで共通なので、1ファイルにつき1回だけ描画する
+    if "html" in OUTPUT_FORMATS or "png" in OUTPUT_FORMATS:
+        preview_pngs = {
+            csv_path: create_preview_png(csv_path, df)
+            for csv_path, df in preview_data.items()
+        }
+
+    if "html" in OUTPUT_FORMATS:
+        write_preview_html(output_html_path, preview_pngs)
+        print("HTMLファイルにグラフを保存しました。")
+
+    if "png" in OUTPUT_FORMATS:
+        write_preview_files(preview_dir, preview_pngs)
+        print("analyze_info_checkディレクトリにグラフを保存しました。")
+
+    write_stage_keys(cache_dir_path, STAGE_NAME, {"check": check_key})
+    return True
 
 
 if __name__ == "__main__":
@@ -7,8 +7,6 @@ summary.xlsxのanalyze_infoシートの記入とdataシートの生成が済ん
 """
 
 import pandas as pd
-import math
-from scipy.interpolate import Akima1DInterpolator
 import numpy as np
 import openpyxl
 from openpyxl.chart import LineChart, Reference
@@ -19,21 +17,41 @@ from openpyxl.utils.dataframe import dataframe_to_rows
 
 from create_analyze_info_check import (
     get_setting_file_path,
-    get_data_dir_path,
     read_dir_name_from_settings,
 )
-
-DEVIATION_IN_ONE_CYCLE = 0.014285714
-CIRCLE_PERIOD = 3
-CIRCLE_HIDE = 2.7
+from blood_pipeline import (
+    BloodPipeline,
+    CIRCLE_PERIOD,
+    WINDOW_SIZE,
+    write_excel_sheets,
+)
+from blood_cache import (
+    hash_values,
+    read_stage_keys,
+    write_stage_keys,
+)
 
 ADD_RANGE = 3
 POINT = 1000
 
-WINDOW_SIZE = 3
-
 OUTPUT_DATA_CYCLE = 0.15
 
+# 出力形式 "xlsx"(nn_data.xlsx), "csv", "parquet"(nn_dataディレクトリにデータごと) から選ぶ
+NN_DATA_FORMATS = ["xlsx"]
+
+# Trueならtarget_flagに加えて多クラスのtarget_labelも出力する
+OUTPUT_TARGET_LABEL = False
+PRE_TARGET_RANGE = 3
+POST_TARGET_RANGE = 3
+
+NO_TARGET_LABEL = 0
+PRE_TARGET_LABEL = 1
+TARGET_WINDOW_LABEL = 2
+POST_TARGET_LABEL = 3
+
+
+STAGE_NAME = "create_data_for_nn"
+
 
 def read_directory_path_from_settings(file_name):
     """
@@ -54,134 +72,6 @@ def read_directory_path_from_settings(file_name):
     return None
 
 
-def get_deviation(analyze_info):
-    """
-    Analyze_infoデータフレームからズレ(deviation)のリストを取得します。
-
-    Args:
-        analyze_info (DataFrame): 分析情報が含まれるPandasのデータフレーム。
-
-    Returns:
-        List[float]: 分析情報から読み取ったズレのリスト。
-    """
-    deviation = (
-        analyze_info[analyze_info[0] == "deviation"].iloc[0, 1:].dropna().tolist()
-    )
-
-    return deviation
-
-
-def get_target_numbers(analyze_info):
-    """
-    Analyze_infoデータフレームから目標値(target number)のリストを取得します。
-
-    Args:
-        analyze_info (DataFrame): 分析情報が含まれるPandasのデータフレーム。
-
-    Returns:
-        List[List[float]]: 目標値のリストのリスト。各サブリストは一つの実験データに対応します。
-    """
-    target_rows = analyze_info[analyze_info[0].str.contains("target number")]
-    target_numbers = target_rows.iloc[:, 1:].values.tolist()
-
-    for i in range(len(target_numbers)):
-        target_numbers[i] = [num for num in target_numbers[i]]
-
-    target_numbers = [list(row) for row in zip(*target_numbers)]
-
-    target_numbers = [
-        [x for x in sublist if not math.isnan(x)] for sublist in target_numbers
-    ]
-
-    return target_numbers
-
-
-def load_sheets(file_path):
-    """
-    指定されたエクセルファイルから必要なシートを読み込み、データフレームの辞書として返します。
-
-    Args:
-        file_path (str): エクセルファイルのパス。
-
-    Returns:
-        dict: キーがシート名、値が対応するデータフレームの辞書。
-    """
-    # エクセルファイルを読み込む
-    excel_file = pd.ExcelFile(file_path)
-
-    # エクセルファイルのすべてのシート名を取得する
-    sheet_names = excel_file.sheet_names
-
-    # ロードしたくないシートをフィルタリングする
-    # analyze_info'を無視し、CH7からCH16のシートをロードしたい。
-    filtered_sheets = [
-        name
-        for name in sheet_names
-        if name not in ["analyze_info"] and name.startswith("CH")
-    ]
-
-    # 必要なシートをデータフレームの辞書に読み込む
-    dataframes = {}
-    for sheet_name in filtered_sheets:
-        df = pd.read_excel(file_path, sheet_name=sheet_name, header=None)
-        df.columns = [
-            f"data{i+1}" for i in range(len(df.columns))
-        ]  # 列名を指定(data1,data2,...)
-        dataframes[sheet_name] = df
-
-    return dataframes
-
-
-def apply_moving_average(dataframes, window_size=WINDOW_SIZE):
-    """
-    各データフレーム内の全ての列に移動平均を適用します。
-
-    Args:
-        dataframes (dict): データフレームの辞書。
-        window_size (int): 移動平均ウィンドウのサイズ。
-
-    Returns:
-        dict: 各列に移動平均を適用したデータフレームの辞書。
-    """
-    ma_dataframes = {}
-    for sheet_name, df in dataframes.items():
-        ma_df = df.rolling(window=window_size, min_periods=1).mean()
-        ma_dataframes[sheet_name] = ma_df
-
-    return ma_dataframes
-
-
-def apply_akima_interpolation(dataframes):
-    """
-    各データフレームの全ての列に秋間補間を適用します。
-
-    Args:
-        dataframes (dict): データフレームの辞書。
-
-    Returns:
-        dict: 各サブ辞書には、データフレームの各列に対する秋間補間オブジェクトが含まれる辞書。
-    """
-    akima_interpolators = {}
-    for sheet_name, df in dataframes.items():
-        interpolators = {}
-        for column in df.columns:
-            # NaN値を持つ列の処理
-            mask = ~np.isnan(df[column])
-            if mask.sum() < 2:
-                # 補間するのに十分なデータポイントがない
-                interpolator = None
-            else:
-                # カラム用の秋間インターポレーターを作成する。
-                data_length = df[column][mask].count()
-                x_axis = [round((i * 0.2), 1) for i in range(data_length.astype(int))]
-                # print(x_axis) DEBUG
-                interpolator = Akima1DInterpolator(x_axis, df[column][mask])
-            interpolators[column] = interpolator
-        akima_interpolators[sheet_name] = interpolators
-
-    return akima_interpolators
-
-
 def plot_series(series):
     """
     DEBUG用
@@ -217,75 +107,110 @@ def plot_akima_interpolation(akima_interp):
     plt.show()
 
 
-def target_number_to_time(deviation, target_numbers):
+def find_in_intervals(x_time, starts, ends):
     """
-    目標値(target number)とズレ(deviation)を時間に変換します。
+    各時刻が[start, end]の区間のいずれかに含まれるかを調べます。
+    区間を開始点でソートし、二分探索で直前に始まった区間までの終了点の最大値とだけ比較します。
 
     Args:
-        deviation (List[float]): ズレのリスト。
-        target_numbers (List[List[float]]): 目標値のリスト。
+        x_time (List[float]): 調べる時刻のリスト。
+        starts (array_like): 区間の開始時刻。
+        ends (array_like): 区間の終了時刻。
 
     Returns:
-        List[List[float]]: ターゲットの提示時間を表す二次元リスト。
+        numpy.ndarray: 各時刻が区間に含まれていればTrueとなるbool配列。
     """
-    target_time = [
-        [target_number * CIRCLE_PERIOD + CIRCLE_HIDE for target_number in sublist]
-        for sublist in target_numbers
-    ]
+    x_time = np.asarray(x_time, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+
+    order = np.argsort(starts)
+    starts = starts[order]
+    max_ends = np.maximum.accumulate(ends[order])
+
+    # 各時刻の直前(同時刻を含む)に始まった区間のインデックス
+    idx = np.searchsorted(starts, x_time, side="right") - 1
+    inside = idx >= 0
+    inside[inside] = x_time[inside] <= max_ends[idx[inside]]
+
+    return inside
 
-    target_time = [
-        [
-            target_number + deviation_item * DEVIATION_IN_ONE_CYCLE
-            for target_number in target_time_sublist
-        ]
-        for deviation_item, target_time_sublist in zip(deviation, target_time)
-    ]
-    # DEBUG
-    # print(target_time)
-    # 正しく時間に変換されていました！
 
-    return target_time
+def make_target_flag(target_time, x_time):
+    """
+    各時刻がターゲット提示からCIRCLE_PERIOD秒間に含まれていれば1、それ以外は0とします。
 
+    Args:
+        target_time (List[float]): ターゲット提示の時刻のリスト。
+        x_time (List[float]): 出力する時刻のリスト。
 
-def transform_dicdic(dicdic):
-    new_dicdic = {}
+    Returns:
+        numpy.ndarray: 0/1のtarget_flag。
+    """
+    target_time = np.asarray(target_time, dtype=float)
+    target_flag = find_in_intervals(x_time, target_time, target_time + CIRCLE_PERIOD)
 
-    for outer_key, inner_dict in dicdic.items():
-        for inner_key, value in inner_dict.items():
-            if inner_key not in new_dicdic:
-                new_dicdic[inner_key] = {}
-            new_dicdic[inner_key][outer_key] = value
+    return target_flag.astype(int)
 
-    return new_dicdic
 
+def make_target_label(
+    target_time, x_time, pre_range=PRE_TARGET_RANGE, post_range=POST_TARGET_RANGE
+):
+    """
+    各時刻に多クラスのラベルを付けます。
+    0:なし, 1:ターゲット提示前pre_range秒間, 2:ターゲット提示からCIRCLE_PERIOD秒間,
+    3:その後post_range秒間。区間が重なる場合は 2 > 1 > 3 の順に優先します。
 
-def make_target_flag(target_time, x_time):
-    target_flag = [0] * len(x_time)
+    Args:
+        target_time (List[float]): ターゲット提示の時刻のリスト。
+        x_time (List[float]): 出力する時刻のリスト。
+        pre_range (float): ターゲット提示前とみなす秒数。
+        post_range (float): ターゲット提示区間の後とみなす秒数。
 
-    for i, t in enumerate(x_time):
-        for target_value in target_time:
-            if target_value <= t <= target_value + CIRCLE_PERIOD:
-                target_flag[i] = 1
-                break
+    Returns:
+        numpy.ndarray: 0~3のtarget_label。
+    """
+    target_time = np.asarray(target_time, dtype=float)
+    target_end = target_time + CIRCLE_PERIOD
 
-    return target_flag
+    # 優先度の低い区間から順に上書きする
+    target_label = np.full(len(x_time), NO_TARGET_LABEL)
+    target_label[find_in_intervals(x_time, target_end, target_end + post_range)] = (
+        POST_TARGET_LABEL
+    )
+    target_label[find_in_intervals(x_time, target_time - pre_range, target_time)] = (
+        PRE_TARGET_LABEL
+    )
+    target_label[find_in_intervals(x_time, target_time, target_end)] = (
+        TARGET_WINDOW_LABEL
+    )
 
+    return target_label
 
-def make_data_df(target_time, data_length, ch_interpolators):
+
+def make_data_df(target_time, data_length, interpolators, channels):
     all_data = {}
-    keys_ordered = list(ch_interpolators.keys())
 
     x_time = [
         round((i * OUTPUT_DATA_CYCLE), 2)
         for i in range(int(data_length / OUTPUT_DATA_CYCLE))
     ]
 
+    # チャンネルをまとめた補間関数ごとに、全チャンネル分を一度に補間する
+    ch_data = {}
+    for interpolator, sheet_names in interpolators:
+        values = interpolator(x_time)
+        for k, sheet_name in enumerate(sheet_names):
+            ch_data[sheet_name] = values[:, k]
+
     all_data["Time"] = x_time
-    for i in range(len(ch_interpolators)):
-        all_data[keys_ordered[i]] = ch_interpolators[keys_ordered[i]](x_time)
+    for ch in channels:
+        all_data[ch] = ch_data[ch]
 
     target_flag = make_target_flag(target_time, x_time)
     all_data["target_flag"] = target_flag
+    if OUTPUT_TARGET_LABEL:
+        all_data["target_label"] = make_target_label(target_time, x_time)
 
     # 最長の列の長さを見つける
     max_length = max(len(lst) for lst in all_data.values())
@@ -301,96 +226,123 @@ def make_data_df(target_time, data_length, ch_interpolators):
     return all_data_df
 
 
-def output_excel_df(nn_data_path, sheet_name, df):
-    df.fillna("", inplace=True)
-    # Excelファイルの存在確認と開く
-    if os.path.exists(nn_data_path):
-        book = openpyxl.load_workbook(nn_data_path)
-    else:
-        book = openpyxl.Workbook()
-
-    sheet_name = sheet_name[:30]
-
-    # シートの処理
-    if sheet_name in book.sheetnames:
-        sheet = book[sheet_name]
-        book.remove(sheet)
-    sheet = book.create_sheet(sheet_name)
-
-    # データフレームの書き込みとフォントの適用
-    yu_gothic_font = Font(name="Yu Gothic")
-    df.fillna("")
-    for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), 1):
-        for c_idx, value in enumerate(row, 1):
-            cell = sheet.cell(row=r_idx, column=c_idx)
-            cell.value = value
-            cell.font = yu_gothic_font
+def output_data_files(nn_data_dir_path, data_dfs, file_format):
+    """
+    NNの学習時にそのまま読み込めるように、データごとに1ファイルずつ書き出します。
 
-    # ファイルの保存前にデフォルトシートを削除
-    if "Sheet" in book.sheetnames and len(book.sheetnames) > 1:
-        std = book["Sheet"]
-        book.remove(std)
+    Args:
+        nn_data_dir_path (str): 出力先ディレクトリのパス。
+        data_dfs (dict): キーがファイル名(拡張子なし)、値が書き込むデータフレームの辞書。
+        file_format (str): "csv"または"parquet"。parquetにはpyarrowが必要です。
+    """
+    if not os.path.isdir(nn_data_dir_path):
+        os.makedirs(nn_data_dir_path)
 
-    # ファイルの保存
-    book.save(nn_data_path)
+    for name, df in data_dfs.items():
+        output_path = os.path.join(nn_data_dir_path, name + "." + file_format)
+        if file_format == "csv":
+            df.to_csv(output_path, index=False)
+        elif file_format == "parquet":
+            df.to_parquet(output_path, index=False)
+        else:
+            raise ValueError("file_format should be csv or parquet")
 
 
-def main():
+def main(data_dir_name=None, pipeline=None):
     """
     プログラムのメイン関数。設定ファイルの読み込み、データ処理、結果のExcel出力を行います。
+    pipelineを渡すと、その読み込み・補間の結果を使い回します(make_blood_outputs.py)。
     """
-    setting_file = get_setting_file_path()
-    data_dir_name = read_dir_name_from_settings(setting_file)
-    data_dir_path = get_data_dir_path(data_dir_name)
-
-    summary_path = os.path.join(data_dir_path, "blood_excel", "summary.xlsx")
-    nn_data_path = os.path.join(data_dir_path, "blood_excel", "nn_data.xlsx")
-
-    if not os.path.isfile(summary_path):
-        print("blood_excelディレクトリにsummary.xlsxがないです")
-        return
-
-    analyze_info = pd.read_excel(
-        summary_path, sheet_name="analyze_info", header=None, engine="openpyxl"
-    )
-
-    deviation = get_deviation(analyze_info)  # 1次元リスト
-
-    target_numbers = get_target_numbers(analyze_info)  # 2次元リスト
-
-    data_dic = load_sheets(summary_path)
-
-    ma_data_dic = apply_moving_average(data_dic)
-
-    # DEBUG
-    # plot_series(ma_data_dic["CH7"]["data1"])
-    # 移動平均は上手く行えていました！
-
-    ch_interpolators_dicdic = apply_akima_interpolation(ma_data_dic)
-
-    # DEBUG
-    # plot_akima_interpolation(ch_interpolators["CH7"]["data1"])
-    # 補間はうまく行えていました！
-
-    if (
-        len(deviation) != len(target_numbers)
-        or len(target_numbers) != len(ch_interpolators_dicdic["CH7"])
-        or len(deviation) != len(ch_interpolators_dicdic["CH7"])
-    ):
-        print("ファイル数やanalyze_infoの内容がおかしい")
-        return
-
-    target_time = target_number_to_time(deviation, target_numbers)
+    if pipeline is None:
+        # data_dir_nameが指定されていなければanalyze_setting.txtから読み込む
+        if data_dir_name is None:
+            setting_file = get_setting_file_path()
+            data_dir_name = read_dir_name_from_settings(setting_file)
+        pipeline = BloodPipeline(data_dir_name)
+    data_dir_name = pipeline.data_dir_name
+    cache_dir_path = pipeline.cache_dir_path
+
+    nn_data_path = os.path.join(pipeline.excel_dir_path, "nn_data.xlsx")
+    nn_data_dir_path = os.path.join(pipeline.excel_dir_path, "nn_data")
+
+    if not pipeline.check():
+        return False
+
+    data_dic = pipeline.data_dic
+    ma_data_dic = pipeline.ma_data_dic
+    target_time = pipeline.target_time
     data_lengths = ma_data_dic["CH7"].count().tolist()
     data_lengths = [round(data_length * 0.2, 1) for data_length in data_lengths]
-    data_interpolators_dicdic = transform_dicdic(ch_interpolators_dicdic)
 
+    # セッションごとに、そのデータとターゲットの時刻、出力の設定からキーを作る
+    params = [WINDOW_SIZE, OUTPUT_DATA_CYCLE, OUTPUT_TARGET_LABEL]
+    params += [PRE_TARGET_RANGE, POST_TARGET_RANGE]
+    session_keys = {}
+    i = 0
+    for data_number in ma_data_dic["CH7"].columns:
+        session_keys[data_number + "_" + data_dir_name] = hash_values(
+            *[df[data_number] for df in data_dic.values()],
+            list(data_dic),
+            target_time[i],
+            data_lengths[i],
+            params,
+        )
+        i += 1
+
+    # 出力ファイルごとに、キーと必要なセッションをまとめる
+    outputs = {}
+    if "xlsx" in NN_DATA_FORMATS:
+        outputs[nn_data_path] = (hash_values(session_keys), list(session_keys))
+    for file_format in ["csv", "parquet"]:
+        if file_format in NN_DATA_FORMATS:
+            for name, key in session_keys.items():
+                path = os.path.join(nn_data_dir_path, name + "." + file_format)
+                outputs[path] = (key, [name])
+
+    # キーが前回と変わった出力ファイルだけを作り直す
+    stage_keys = read_stage_keys(cache_dir_path, STAGE_NAME)
+    stale_outputs = {
+        path: output
+        for path, output in outputs.items()
+        if stage_keys.get(os.path.basename(path)) != output[0]
+        or not os.path.isfile(path)
+    }
+    if not stale_outputs:
+        print("入力に変更がないため、nn_dataの作成を省略しました")
+        return True
+
+    stale_sessions = {name for _, names in stale_outputs.values() for name in names}
+
+    data_dfs = {}
     i = 0
-    for data_number, ch_interpolators in data_interpolators_dicdic.items():
-        data_df = make_data_df(target_time[i], data_lengths[i], ch_interpolators)
-        output_excel_df(nn_data_path, data_number + "_" + data_dir_name, data_df)
+    for data_number, interpolators in pipeline.data_interpolators.items():
+        name = data_number + "_" + data_dir_name
+        if name in stale_sessions:
+            data_dfs[name] = make_data_df(
+                target_time[i], data_lengths[i], interpolators, list(ma_data_dic)
+            )
         i += 1
 
+    if nn_data_path in stale_outputs:
+        # シート名は31文字までなので切り詰め、NaNは空欄にする
+        write_excel_sheets(
+            nn_data_path,
+            {name[:30]: df.fillna("") for name, df in data_dfs.items()},
+        )
+    for file_format in ["csv", "parquet"]:
+        stale_dfs = {
+            name: df
+            for name, df in data_dfs.items()
+            if os.path.join(nn_data_dir_path, name + "." + file_format) in stale_outputs
+        }
+        if stale_dfs:
+            output_data_files(nn_data_dir_path, stale_dfs, file_format)
+
+    for path, output in stale_outputs.items():
+        stage_keys[os.path.basename(path)] = output[0]
+    write_stage_keys(cache_dir_path, STAGE_NAME, stage_keys)
+    return True
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,236 @@
+"""
+_Oxy.csvの先頭DISPLAY_DATA_RANGE行から、LEDによる外乱の終了点(disturbance end)とdeviation(ずれ)を推定し、
+summary.xlsxのanalyze_infoシートに確信度(confidence)とともに書き込む
+
+推定方法---
+外乱中はLEDの点灯・消灯のサンプルが交互に並び、1階差分が大きくなるので、その絶対値を全チャンネルで平均する
+この値の平均が前後で最も大きく変わる点(変化点)を探し、その近くで差分が大きい最後の点の次を外乱の終了点とする
+deviationは仕様書の定義どおり、足並みがそろった点(点灯が2点連続し、差分が小さくなる点)からオドボール開始点(外乱の終了点)までのデータ数
+確信度は変化点の前後の平均の差を、前後の平均の和で割った値(0~1)
+推定できなかった値(外乱が見つからない、値が一定など)は書き込まない
+
+出力---
+analyze_infoシートに"disturbance end (auto)"、"deviation (auto)"、"confidence (auto)"の行を書き込む
+--applyを付けると、"disturbance end"と"deviation"の行の空欄にも推定値を書き込む
+summary.xlsxが無い場合は、推定値の行を入れたanalyze_infoシートだけのsummary.xlsxを作成する(--applyを付けない限り、disturbance endとdeviationの行は空欄のまま)
+推定値はあくまで候補なので、analyze_info_check.xlsxなどで確認してから使うこと
+"""
+
+import argparse
+import os
+import numpy as np
+import openpyxl
+from openpyxl.styles import Font
+
+from create_analyze_info_check import (
+    get_setting_file_path,
+    get_data_dir_path,
+    read_dir_name_from_settings,
+    read_preview_data,
+)
+from make_summary_data import get_csv_files_from_folder
+
+MIN_SEGMENT = 10  # 変化点の前後に最低限必要なサンプル数
+
+AUTO_SUFFIX = " (auto)"
+
+
+def detect_disturbance_end(values):
+    """
+    外乱の終了点とdeviationを推定します。
+
+    Args:
+        values (numpy.ndarray): 先頭DISPLAY_DATA_RANGE行のデータ(行がサンプル、列がチャンネル)。
+
+    Returns:
+        tuple: (disturbance end, deviation, confidence)。
+               disturbance endはanalyze_info_check.xlsxのグラフと同じく1から数えたサンプル番号。
+               推定できなかった値はNone(confidenceは0)。
+    """
+    # 高周波成分の大きさ。チャンネルごとの大きさの違いを中央値でそろえてから平均する
+    # 値が一定のチャンネル(中央値が0)や空のチャンネルは平均に使わない
+    energy = np.abs(np.diff(values, axis=0))
+    energy = energy[:, np.isfinite(energy).any(axis=0)]
+    if len(energy) < 2 * MIN_SEGMENT or energy.shape[1] == 0:
+        return None, None, 0.0
+    scale = np.nanmedian(energy, axis=0)
+    if not (scale > 0).any():
+        return None, None, 0.0
+    energy = np.nanmean(energy[:, scale > 0] / scale[scale > 0], axis=1)
+
+    # 外乱の区間[start, end)の内外の平均の差(の重み付き値)が最大になる区間を探す
+    # 記録の開始から外乱までの間(外乱の前)は無くてもよい
+    n = len(energy)
+    cumsum = np.concatenate([[0], np.cumsum(energy)])
+    start, end = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing="ij")
+    inside = end - start
+    valid = (inside >= MIN_SEGMENT) & (n - inside >= MIN_SEGMENT)
+    mean_inside = (cumsum[end] - cumsum[start]) / np.maximum(inside, 1)
+    mean_outside = (cumsum[-1] - cumsum[end] + cumsum[start]) / np.maximum(
+        n - inside, 1
+    )
+    score = (mean_inside - mean_outside) * np.sqrt(
+        np.clip(inside * (n - inside), 0, None) / n
+    )
+    score[~valid] = -np.inf
+    start, end = np.unravel_index(np.argmax(score), score.shape)
+    mean_inside, mean_outside = mean_inside[start, end], mean_outside[start, end]
+    if mean_inside <= mean_outside:
+        # 変動が大きい区間が無い(外乱が見つからない)
+        return None, None, 0.0
+
+    # 区間の終わりの近くで、内外の平均の中間より変動が大きい最後の差分(最後の点灯→消灯)を探す
+    # energy[i]はサンプルiとi+1の差。最後の消灯(0.2秒)にサンプルが1つあるので、その次から外乱が終わっている
+    level = (mean_inside + mean_outside) / 2
+    change_point = int(end) + 1
+    near = np.arange(max(end - MIN_SEGMENT // 2, start), min(end + MIN_SEGMENT // 2, n))
+    large = near[energy[near] >= level]
+    if len(large):
+        change_point = int(large[-1]) + 2
+    disturbance_end = change_point + 1
+
+    # 外乱中は点灯・消灯のサンプルが交互に並び差分が大きいが、点灯が2点連続した所だけ差分が小さい
+    # 外乱の最初の差分と最後の消灯を除き、差分が中間の値を下回る最後の位置を足並みがそろった点とする
+    near = np.arange(max(start - MIN_SEGMENT // 2, 0), change_point)
+    large = near[energy[near] >= level]
+    disturbance_start = int(large[0]) if len(large) else start
+    deviation = None
+    aligned = np.flatnonzero(energy[disturbance_start + 1 : change_point - 1] < level)
+    aligned += disturbance_start + 1
+    if len(aligned):
+        # 2点連続した点の1点目(0から数える)から、オドボール開始点までのデータ数
+        deviation = change_point - int(aligned[-1])
+
+    confidence = float(
+        np.clip((mean_inside - mean_outside) / (mean_inside + mean_outside), 0, 1)
+    )
+
+    return disturbance_end, deviation, round(confidence, 3)
+
+
+def find_row(ws, label):
+    """A列がlabelの行番号を返す。無ければNoneを返す"""
+    for row in range(1, ws.max_row + 1):
+        if ws.cell(row=row, column=1).value == label:
+            return row
+    return None
+
+
+def find_columns(ws, csv_files):
+    """
+    1行目にファイル名が並んでいればその列番号を、そうでなければB列から順に列番号を返す
+    """
+    header = [ws.cell(row=1, column=col).value for col in range(1, ws.max_column + 1)]
+    if all(csv_file in header for csv_file in csv_files):
+        return [header.index(csv_file) + 1 for csv_file in csv_files]
+    return [i + 2 for i in range(len(csv_files))]
+
+
+def write_row(ws, label, values, columns, only_empty=False):
+    """A列がlabelの行(無ければ末尾に追加)のcolumnsの列にvaluesを書き込む"""
+    font = Font(name="Yu Gothic")
+    row = find_row(ws, label)
+    if row is None:
+        # 空のシートなら1行目から書き込む
+        empty = ws.max_row == 1 and ws.cell(row=1, column=1).value is None
+        row = 1 if empty else ws.max_row + 1
+        ws.cell(row=row, column=1, value=label).font = font
+
+    for column, value in zip(columns, values):
+        cell = ws.cell(row=row, column=column)
+        if value is None or (only_empty and cell.value is not None):
+            # 推定できなかった値は書き込まない
+            continue
+        cell.value = value
+        cell.font = font
+
+
+def write_analyze_info(summary_path, csv_files, detections, apply=False):
+    """
+    推定値をsummary.xlsxのanalyze_infoシートに書き込みます。
+
+    Args:
+        summary_path (str): summary.xlsxのパス。
+        csv_files (List[str]): _Oxy.csvのファイル名のリスト。
+        detections (List[tuple]): detect_disturbance_endの戻り値のリスト。
+        apply (bool): Trueなら"disturbance end"と"deviation"の行の空欄にも書き込む。
+    """
+    disturbance_ends = [detection[0] for detection in detections]
+    deviations = [detection[1] for detection in detections]
+    confidences = [detection[2] for detection in detections]
+
+    if os.path.isfile(summary_path):
+        wb = openpyxl.load_workbook(summary_path)
+    else:
+        wb = openpyxl.Workbook()
+        wb.active.title = "analyze_info"
+        write_row(wb.active, "file", csv_files, find_columns(wb.active, csv_files))
+        # make_summary_data.pyは2行目を外乱終了点として読むので、手入力用の行を空欄で先に作る
+        empty = [None] * len(csv_files)
+        write_row(wb.active, "disturbance end", empty, find_columns(wb.active, []))
+        write_row(wb.active, "deviation", empty, find_columns(wb.active, []))
+
+    if "analyze_info" in wb.sheetnames:
+        ws = wb["analyze_info"]
+    else:
+        ws = wb.create_sheet("analyze_info", 0)
+    columns = find_columns(ws, csv_files)
+
+    if apply:
+        write_row(ws, "disturbance end", disturbance_ends, columns, only_empty=True)
+        write_row(ws, "deviation", deviations, columns, only_empty=True)
+
+    write_row(ws, "disturbance end" + AUTO_SUFFIX, disturbance_ends, columns)
+    write_row(ws, "deviation" + AUTO_SUFFIX, deviations, columns)
+    write_row(ws, "confidence" + AUTO_SUFFIX, confidences, columns)
+
+    wb.save(summary_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--apply",
+        action="store_true",
+        help="disturbance endとdeviationの行の空欄にも推定値を書き込む",
+    )
+    return parser.parse_args()
+
+
+def main(data_dir_name=None, apply=False):
+    # data_dir_nameが指定されていなければanalyze_setting.txtから読み込む
+    if data_dir_name is None:
+        setting_file = get_setting_file_path()
+        data_dir_name = read_dir_name_from_settings(setting_file)
+    data_dir_path = get_data_dir_path(data_dir_name)
+
+    csv_dir_path = os.path.join(data_dir_path, "blood_csv")
+    excel_directory = os.path.join(data_dir_path, "blood_excel")
+    summary_path = os.path.join(excel_directory, "summary.xlsx")
+
+    # make_summary_data.pyと同じ順番でファイルを並べる
+    csv_files = get_csv_files_from_folder(csv_dir_path, "_Oxy")
+    if not csv_files:
+        print("指定された部分文字列を持つCSVファイルが見つかりません。")
+        return False
+
+    detections = []
+    for csv_file in csv_files:
+        preview_data = read_preview_data(os.path.join(csv_dir_path, csv_file))
+        detection = detect_disturbance_end(preview_data.to_numpy(dtype=float))
+        detections.append(detection)
+        print(
+            csv_file, "disturbance end：%s deviation：%s confidence：%.3f" % detection
+        )
+
+    if not os.path.isdir(excel_directory):
+        os.mkdir(excel_directory)
+        print("blood_excelディレクトリを作成しました。")
+
+    write_analyze_info(summary_path, csv_files, detections, apply)
+    print("analyze_infoシートに推定値を書き込みました")
+    return True
+
+
+if __name__ == "__main__":
+    main(apply=parse_args().apply)
@@ -0,0 +1,32 @@
+"""
+result.xlsx(analyze_blood.py)とnn_data(create_data_for_nn.py)をまとめて作成するプログラム
+summary.xlsxの読み込み・移動平均・秋間補間は一度だけ行い、両方の出力で使い回す
+
+実行条件
+analyze_setting.txtへのデータディレクトリの記述
+summary.xlsxのanalyze_infoシートの記入とdataシートの生成が済んでいること
+"""
+
+import analyze_blood
+import create_data_for_nn
+from blood_pipeline import BloodPipeline
+from create_analyze_info_check import (
+    get_setting_file_path,
+    read_dir_name_from_settings,
+)
+
+
+def main(data_dir_name=None):
+    # data_dir_nameが指定されていなければanalyze_setting.txtから読み込む
+    if data_dir_name is None:
+        setting_file = get_setting_file_path()
+        data_dir_name = read_dir_name_from_settings(setting_file)
+
+    pipeline = BloodPipeline(data_dir_name)
+    if not analyze_blood.main(pipeline=pipeline):
+        return False
+    return create_data_for_nn.main(pipeline=pipeline)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,42 @@ blood_excelディレクトリにanalyze_infoシートが完成したsummary.xlsx
 """
 
 import os
+import tempfile
+import zipfile
+import xml.etree.ElementTree as ET
+import numpy as np
 import pandas as pd
-from openpyxl.styles import Font
+import openpyxl
+from openpyxl.styles import Font, NamedStyle
+from openpyxl.utils import get_column_letter
 
 from create_analyze_info_check import (
     get_setting_file_path,
     get_data_dir_path,
     read_dir_name_from_settings,
 )
+from blood_cache import (
+    SUMMARY_STAGE_NAME,
+    SUMMARY_KEY,
+    get_cache_dir_path,
+    write_blood_cache,
+    hash_file,
+    hash_values,
+    read_stage_keys,
+    write_stage_keys,
+    read_stage_array,
+    write_stage_array,
+)
 
 SKIP_ROWS_NUMBER = 54
 
+STAGE_NAME = SUMMARY_STAGE_NAME
+
+FONT_STYLE_NAME = "yu_gothic"
+
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
 
 def get_csv_files_from_folder(folder_path, substring):
     """指定されたフォルダから、部分文字列.csvを含む csv ファイルのリストを返します。"""
@@ -34,41 +59,163 @@ def read_analyze_info_from_excel(summary_path):
         return []
 
 
-def read_data_for_columns(csv_directory_path, csv_file, column_index, skip_rows_total):
+def read_data_for_columns(
+    csv_directory_path, csv_file, column_indexes, skip_rows_number
+):
+    """csvファイルを一度だけ読み込み、指定された全ての列を2次元のfloat配列として返す
+
+    Args:
+        csv_directory_path (str): csvファイルがあるディレクトリのパス。
+        csv_file (str): csvファイル名。
+        column_indexes (List[int]): 読み込む列番号のリスト。
+        skip_rows_number (int): 先頭から読み飛ばす行数(ヘッダ+外乱終了点)。
+
+    Returns:
+        numpy.ndarray: 行がサンプル、列がcolumn_indexesの順に並んだ配列。
+    """
     data = pd.read_csv(
         os.path.join(csv_directory_path, csv_file),
         encoding="Shift-JIS",
-        skiprows=skip_rows_total,
+        skiprows=skip_rows_number,
         header=None,
-        usecols=[column_index],
+        usecols=column_indexes,
+        engine="c",
+    )
+    return data[column_indexes].to_numpy(dtype=float)
+
+
+def find_sheet_parts(xlsx):
+    """ブック内のシート名と、そのシートのXMLファイル(zip内のパス)の対応を返す"""
+    workbook = ET.fromstring(xlsx.read("xl/workbook.xml"))
+    rels = ET.fromstring(xlsx.read("xl/_rels/workbook.xml.rels"))
+    targets = {rel.get("Id"): rel.get("Target") for rel in rels}
+
+    sheet_parts = {}
+    for sheet in workbook.iter(f"{{{MAIN_NS}}}sheet"):
+        target = targets[sheet.get(f"{{{REL_NS}}}id")]
+        if target.startswith("/"):
+            sheet_parts[sheet.get("name")] = target[1:]
+        else:
+            sheet_parts[sheet.get("name")] = "xl/" + target
+
+    return sheet_parts
+
+
+def find_named_style_id(xlsx, style_name):
+    """名前付きスタイルを適用したセルの書式番号(sの値)を返す。無ければNoneを返す"""
+    styles = ET.fromstring(xlsx.read("xl/styles.xml"))
+    xf_id = None
+    for cell_style in styles.iter(f"{{{MAIN_NS}}}cellStyle"):
+        if cell_style.get("name") == style_name:
+            xf_id = cell_style.get("xfId")
+    if xf_id is None:
+        return None
+
+    style_font = styles.find(f"{{{MAIN_NS}}}cellStyleXfs")[int(xf_id)].get("fontId")
+    for i, xf in enumerate(styles.find(f"{{{MAIN_NS}}}cellXfs")):
+        if xf.get("xfId") == xf_id and xf.get("fontId") == style_font:
+            return i
+    return None
+
+
+def make_sheet_xml(df, style_id):
+    """
+    データフレームの値を、全セルに書式番号style_idを付けたワークシートのXMLにします。
+    NaNやinfのセルは書き込みません(xlsxに書ける数値ではないので、openpyxlと同じく空欄にする)。
+    """
+    values = df.to_numpy(dtype=float)
+    letters = [get_column_letter(j + 1) for j in range(values.shape[1])]
+
+    rows = []
+    for i, row in enumerate(values, start=1):
+        cells = "".join(
+            f'<c r="{letter}{i}" s="{style_id}"><v>{float(value)!r}</v></c>'
+            for letter, value in zip(letters, row)
+            if np.isfinite(value)
+        )
+        if cells:
+            rows.append(f'<row r="{i}">{cells}</row>')
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        f'<worksheet xmlns="{MAIN_NS}"><sheetData>{"".join(rows)}</sheetData></worksheet>'
     )
-    return data
+
+
+def replace_sheet_parts(excel_path, data_dfs):
+    """
+    summary.xlsxの中のCHシートのXMLだけを差し替えます。
+    analyze_infoなど他のシートや書式のXMLはそのままコピーするので、手入力した内容は変わりません。
+
+    Returns:
+        bool: 差し替えられたらTrue。CHシートや名前付きスタイルが無い場合はFalse。
+    """
+    with zipfile.ZipFile(excel_path) as xlsx:
+        sheet_parts = find_sheet_parts(xlsx)
+        style_id = find_named_style_id(xlsx, FONT_STYLE_NAME)
+        if style_id is None or not all(ch in sheet_parts for ch in data_dfs):
+            return False
+
+        new_parts = {
+            sheet_parts[ch]: make_sheet_xml(df, style_id) for ch, df in data_dfs.items()
+        }
+
+    # 同じディレクトリに書き出してから置き換える。失敗したら書きかけのファイルを消す
+    fd, temp_path = tempfile.mkstemp(suffix=".xlsx", dir=os.path.dirname(excel_path))
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(excel_path) as xlsx, zipfile.ZipFile(
+            temp_path, "w", zipfile.ZIP_DEFLATED
+        ) as new_xlsx:
+            for item in xlsx.infolist():
+                if item.filename in new_parts:
+                    new_xlsx.writestr(item, new_parts[item.filename])
+                else:
+                    new_xlsx.writestr(item, xlsx.read(item.filename))
+        os.replace(temp_path, excel_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return True
 
 
 def write_data_to_excel(excel_path, data_dfs):
-    """Write data to the Excel file with the specified font."""
-    with pd.ExcelFile(excel_path, engine="openpyxl") as xls:
-        sheets = {sheet_name: xls.parse(sheet_name) for sheet_name in xls.sheet_names}
-
-    with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
-        font = Font(name="Yu Gothic")
-        for sheet_name, data in sheets.items():
-            data.to_excel(writer, sheet_name=sheet_name, index=False)
-            ws = writer.book[sheet_name]
-            for row in ws.iter_rows():
-                for cell in row:
-                    cell.font = font
-        for ch, df in data_dfs.items():
-            df.to_excel(writer, sheet_name=ch, index=False, header=False)
-            ws = writer.book[ch]
-            for row in ws.iter_rows():
-                for cell in row:
-                    cell.font = font
-
-
-def main():
-    setting_file = get_setting_file_path()
-    data_dir_name = read_dir_name_from_settings(setting_file)
+    """
+    summary.xlsxのCHシートだけを書き換えます。フォントは名前付きスタイルとして一度だけ登録します。
+    CHシートが既にあればそのXMLだけを差し替え、無ければopenpyxlでシートを追加します。
+    """
+    if replace_sheet_parts(excel_path, data_dfs):
+        return
+
+    wb = openpyxl.load_workbook(excel_path)
+    if FONT_STYLE_NAME not in wb.named_styles:
+        wb.add_named_style(
+            NamedStyle(name=FONT_STYLE_NAME, font=Font(name="Yu Gothic"))
+        )
+
+    for ch, df in data_dfs.items():
+        if ch in wb.sheetnames:
+            # 古いCHシートは同じ位置に作り直す
+            index = wb.sheetnames.index(ch)
+            wb.remove(wb[ch])
+            ws = wb.create_sheet(ch, index)
+        else:
+            ws = wb.create_sheet(ch)
+
+        for i, row in enumerate(df.to_numpy(dtype=float), start=1):
+            for j, value in enumerate(row, start=1):
+                if np.isfinite(value):
+                    ws.cell(row=i, column=j, value=float(value)).style = FONT_STYLE_NAME
+
+    wb.save(excel_path)
+
+
+def main(data_dir_name=None):
+    # data_dir_nameが指定されていなければanalyze_setting.txtから読み込む
+    if data_dir_name is None:
+        setting_file = get_setting_file_path()
+        data_dir_name = read_dir_name_from_settings(setting_file)
     data_dir_path = get_data_dir_path(data_dir_name)
 
     csv_dir_path = os.path.join(data_dir_path, "blood_csv")
@@ -76,38 +223,77 @@ def main():
 
     if not os.path.isfile(summary_path):
         print("blood_excelディレクトリにsummary.xlsxを追加し、analyze_infoシートを埋めてください")
-        return
+        return False
 
     disturbance_end = read_analyze_info_from_excel(summary_path)
 
     # disturbance_endが空の場合、エラーメッセージを表示して終了
     if len(disturbance_end) == 0:
         print("Error: analyze_infoシートのdisturbance endを埋めてください")
-        return
+        return False
 
     csv_files = get_csv_files_from_folder(csv_dir_path, "_Oxy")
 
     if not csv_files:
         print("指定された部分文字列を持つCSVファイルが見つかりません。")
-        return
+        return False
 
     if len(disturbance_end) != len(csv_files):
         print("CSVファイル数と開始点が一致していません。")
-        return
+        return False
 
-    columns = range(7, 17)
+    columns = list(range(7, 17))
     data_dfs = {f"CH{column}": pd.DataFrame() for column in columns}
 
+    # csvファイルの内容と外乱終了点が前回と同じセッションは、保存しておいた配列を使う
+    cache_dir_path = get_cache_dir_path(summary_path)
+    old_keys = read_stage_keys(cache_dir_path, STAGE_NAME)
+    new_keys = {}
+
     for i, csv_file in enumerate(csv_files):
-        skip_rows_total = range(0, SKIP_ROWS_NUMBER + int(disturbance_end[i]))
-        for column in columns:
-            column_data = read_data_for_columns(
-                csv_dir_path, csv_file, column, skip_rows_total
+        skip_rows_number = SKIP_ROWS_NUMBER + int(disturbance_end[i])
+        key = hash_values(
+            hash_file(os.path.join(csv_dir_path, csv_file)), skip_rows_number, columns
+        )
+        new_keys[csv_file] = key
+
+        columns_data = None
+        if old_keys.get(csv_file) == key:
+            columns_data = read_stage_array(cache_dir_path, STAGE_NAME, csv_file)
+        if columns_data is None:
+            # 1ファイルにつき1回だけ読み込み、全チャンネルをまとめて取り出す
+            columns_data = read_data_for_columns(
+                csv_dir_path, csv_file, columns, skip_rows_number
             )
-            data_dfs[f"CH{column}"][csv_file] = column_data.squeeze()
+            write_stage_array(cache_dir_path, STAGE_NAME, csv_file, columns_data)
+
+        for j, column in enumerate(columns):
+            data_dfs[f"CH{column}"][csv_file] = pd.Series(columns_data[:, j])
+
+    write_blood_cache(cache_dir_path, data_dfs)
+
+    # 全セッションの入力が前回と同じで、summary.xlsxが前回書き込んだときのまま(CHシートが
+    # キャッシュと同じ)なら書き込みを省く。summary.xlsxが変わっていればCHシートを書き直す
+    new_keys["summary"] = hash_values(*[new_keys[csv_file] for csv_file in csv_files])
+    with pd.ExcelFile(summary_path, engine="openpyxl") as xls:
+        has_ch_sheets = all(ch in xls.sheet_names for ch in data_dfs)
+    summary_hash = hash_file(summary_path)
+    if (
+        old_keys.get("summary") == new_keys["summary"]
+        and old_keys.get(SUMMARY_KEY) == summary_hash
+        and has_ch_sheets
+    ):
+        new_keys[SUMMARY_KEY] = summary_hash
+        write_stage_keys(cache_dir_path, STAGE_NAME, new_keys)
+        print("入力に変更がないため、summary.xlsxの書き込みを省略しました")
+        return True
 
     write_data_to_excel(summary_path, data_dfs)
+    # キャッシュと同じデータを書いたsummary.xlsxのハッシュ値を記録する
+    new_keys[SUMMARY_KEY] = hash_file(summary_path)
+    write_stage_keys(cache_dir_path, STAGE_NAME, new_keys)
     print("データを書きました")
+    return True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,56 @@
+"""
+blood_pipeline.apply_akima_interpolationのテスト
+チャンネルの係数をまとめた区分多項式の値が、チャンネルごとの秋間補間と完全に一致することを確かめる
+
+実行方法---
+python -m pytest test_blood_pipeline.py
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import Akima1DInterpolator
+
+from blood_pipeline import SAMPLING_PERIOD, apply_akima_interpolation
+
+
+def make_dataframes():
+    """大きさが大きく異なるチャンネルと、データ数が違う列を含むデータフレームの辞書を作る"""
+    rng = np.random.default_rng(0)
+    length = 50
+    small = rng.normal(size=length).cumsum() * 1e-3
+    small[20:24] = small[20]  # 傾きが0の区間
+    large = rng.normal(size=length).cumsum() * 1e6
+    short = rng.normal(size=length)
+    short[40:] = np.nan
+
+    return {
+        "CH7": pd.DataFrame({"data1": small, "data2": short}),
+        "CH8": pd.DataFrame({"data1": large, "data2": large}),
+        "CH9": pd.DataFrame({"data1": short, "data2": small}),
+    }
+
+
+def test_stacked_interpolation_matches_each_channel():
+    dataframes = make_dataframes()
+    akima_interpolators = apply_akima_interpolation(dataframes)
+
+    for column, interpolators in akima_interpolators.items():
+        sheet_names_seen = []
+        for interpolator, sheet_names in interpolators:
+            x_axis = interpolator.x
+            x_new = np.linspace(x_axis[0], x_axis[-1], 1000)
+            stacked = interpolator(x_new)
+
+            for j, sheet_name in enumerate(sheet_names):
+                values = dataframes[sheet_name][column].dropna()
+                expected_x = np.round(np.arange(len(values)) * SAMPLING_PERIOD, 1)
+                expected = Akima1DInterpolator(expected_x, values)
+
+                np.testing.assert_array_equal(x_axis, expected_x)
+                np.testing.assert_array_equal(stacked[:, j], expected(x_new))
+                np.testing.assert_array_equal(
+                    interpolator(x_axis[-1] + 1)[j], expected(x_axis[-1] + 1)
+                )
+            sheet_names_seen += sheet_names
+
+        assert sorted(sheet_names_seen) == sorted(dataframes)
@@ -7,15 +7,22 @@ Python環境が必要。
 Pandasライブラリが必要。
 設定ファイル（analyze_setting.txt）とデータCSVファイルが必要。
 コマンドラインから python artifact_remove.py で実行。
+python artifact_remove.py --jobs 4 のように指定すると、ファイルを並列に処理する。
 
 出力---
 処理後のデータは、元のファイルのディレクトリ内に artifact_removed というサブディレクトリに保存されます。
 ファイル名は元の名前に _artifact_removed.csv が追加されます。
 """
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import os
 import glob
 
+EEG_CHANNELS = [" 1-REF"]  # アーチファクトを除去するチャンネル(列名)
+OUTPUT_ARTIFACT_MASK = False  # Trueならartifact_maskディレクトリにマスクも保存する
+
 
 def get_setting_file_path():
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -67,7 +74,57 @@ def make_output_path(input_path):
     return output_path
 
 
-def remove_artifacts_from_csv(file_path, output_path=None, threshold=50):
+def make_mask_output_path(input_path):
+    """アーチファクトマスクの出力ファイルのパスを作成し返す
+
+    Args:
+        input_path (str): 入力ファイル
+
+    Return:
+        output_path(str): 出力先
+    """
+
+    base_name = os.path.basename(input_path)
+    file_name = base_name.rsplit(".", 1)[0]
+    new_file_name = file_name + "_artifact_mask" + ".csv"
+    eeg_csv_dir = os.path.dirname(input_path)
+
+    # eeg_add.pyがartifact_removed内のcsvをすべて読むため、別ディレクトリに保存する
+    output_dir = os.path.join(eeg_csv_dir, "artifact_mask")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    output_path = os.path.join(output_dir, new_file_name)
+    return output_path
+
+
+def make_artifact_mask(values, threshold=50):
+    """
+    しきい値を超えた区間をアーチファクトとしてマスクを作成します。全チャンネルをまとめて処理します。
+
+    パラメータ
+    values (numpy.ndarray): 脳波データ(行がサンプル、列がチャンネル)。
+    threshold (int): アーチファクトを判定するための閾値。デフォルトは±50。
+
+    戻り値
+    numpy.ndarray: valuesと同じ形のbool配列。アーチファクトとして除去するサンプルがTrue。
+    """
+    over_threshold = np.abs(values) > threshold
+
+    # しきい値を超えた区間に加えて、区間が終わった直後の1点も除去する
+    mask = over_threshold.copy()
+    mask[1:] |= over_threshold[:-1]
+
+    return mask
+
+
+def remove_artifacts_from_csv(
+    file_path,
+    output_path=None,
+    threshold=50,
+    channels=EEG_CHANNELS,
+    mask_output_path=None,
+):
     """
     脳波データのCSVファイルからアーチファクトを除去し、クリーンなデータを新しいCSVファイルに保存します。
 
@@ -75,30 +132,20 @@ def remove_artifacts_from_csv(file_path, output_path=None, threshold=50):
     file_path (str): 脳波データを含むCSVファイルへのパス。
     output_path (str): クリーニングされたデータを保存するパス。
     threshold (int): アーチファクトを判定するための閾値。デフォルトは±50。
+    channels (list): アーチファクトを除去するチャンネル(列名)のリスト。
+    mask_output_path (str): 指定した場合、チャンネルごとのアーチファクトマスク(0/1)を保存するパス。
+
+    戻り値
+    pandas.DataFrame: チャンネルごとのアーチファクトマスク。
     """
 
     data = pd.read_csv(file_path)
 
-    in_artifact = False
-    start_index = None
-
-    for i, value in enumerate(data[" 1-REF"]):
-        # 現在値がしきい値を超えているかチェックする
-        if abs(value) > threshold:
-            # アーティファクトの開始
-            if not in_artifact:
-                in_artifact = True
-                start_index = i
-        else:
-            # アーティファクトの終わり
-            if in_artifact:
-                # アーティファクトの「ピーク」または「バレー」の値をすべてゼロにする。
-                data.loc[start_index:i, " 1-REF"] = 0
-                in_artifact = False
-
-    # 最後の値がアーティファクトの一部であるかどうかをチェックする
-    if in_artifact:
-        data.loc[start_index:, " 1-REF"] = 0
+    mask = make_artifact_mask(data[channels].to_numpy(dtype=float), threshold)
+
+    # アーチファクトの「ピーク」または「バレー」の値をすべてゼロにする。
+    # 整数の列は整数のまま残す(元の値と同じ書式でcsvに書き出す)
+    data[channels] = data[channels].mask(mask, 0)
 
     if not output_path:
         output_path = make_output_path(file_path)
@@ -106,21 +153,67 @@ def remove_artifacts_from_csv(file_path, output_path=None, threshold=50):
     # クリーニングしたデータを新しいCSVファイルに保存する。
     data.to_csv(output_path, index=False)
 
+    mask_df = pd.DataFrame(mask.astype(int), columns=channels)
+    if mask_output_path:
+        mask_df.to_csv(mask_output_path, index=False)
+
+    return mask_df
+
+
+def remove_artifacts_from_file(file_path):
+    """main用。1ファイルのアーチファクトを除去し、設定に応じてマスクも保存します。"""
+    mask_output_path = None
+    if OUTPUT_ARTIFACT_MASK:
+        mask_output_path = make_mask_output_path(file_path)
+    remove_artifacts_from_csv(file_path, mask_output_path=mask_output_path)
+
+
+def map_files(func, jobs, *iterables):
+    """
+    ファイルごとの処理をjobs個のプロセスで並列に実行し、結果を入力と同じ順に返します。
+
+    パラメータ
+    func (function): 各ファイルに適用する関数。モジュールのトップレベルで定義されている必要がある。
+    jobs (int): 並列に実行するプロセス数。1以下なら並列化せずに順番に処理する。
+    iterables: funcに渡す引数のリスト(ファイルのリストなど)。
+
+    戻り値
+    list: funcの戻り値のリスト。
+    """
+    if jobs <= 1:
+        return list(map(func, *iterables))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, *iterables))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="並列に処理するファイル数(プロセス数)"
+    )
+    return parser.parse_args()
+
 
-def main():
-    setting_file = get_setting_file_path()
-    data_dir_name = read_dir_name_from_settings(setting_file)
+def main(jobs=1, data_dir_name=None):
+    # data_dir_nameが指定されていなければanalyze_setting.txtから読み込む
+    if data_dir_name is None:
+        setting_file = get_setting_file_path()
+        data_dir_name = read_dir_name_from_settings(setting_file)
     data_dir_path = get_data_dir_path(data_dir_name)
 
     csv_dir_path = os.path.join(data_dir_path, "eeg_csv")
 
     # ディレクトリ内のすべての.csvファイルを取得
     csv_files = glob.glob(csv_dir_path + "/*.csv")
+    if not csv_files:
+        print("eeg_csvディレクトリにCSVファイルが見つかりません。")
+        return False
 
-    # 各ファイルを一つずつ処理
-    for file in csv_files:
-        remove_artifacts_from_csv(file)
+    # 各ファイルを処理(--jobsが2以上なら並列に処理)
+    map_files(remove_artifacts_from_file, jobs, csv_files)
+    return True
 
 
 if __name__ == "__main__":
-    main()
+    main(parse_args().jobs)
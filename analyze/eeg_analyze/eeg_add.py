@@ -8,12 +8,14 @@ artifact_remove.py からいくつかの関数をインポートしています
 analyze_setting.txt と名付けられた設定ファイルが必要です。
 加工対象のCSVファイルが、特定のディレクトリ構造内に存在する必要があります。
 コマンドラインから python eeg_add.py で実行します。
+python eeg_add.py --jobs 4 のように指定すると、ファイルごとの処理を並列に行います。
 
 出力---
 加算された脳波データのグラフを表示します。
 """
 import glob
 import math
+import sys
 from matplotlib import pyplot as plt
 import numpy as np
 import openpyxl
@@ -25,8 +27,18 @@ from artifact_remove import (
     get_setting_file_path,
     get_data_dir_path,
     read_dir_name_from_settings,
+    make_artifact_mask,
+    map_files,
+    parse_args,
+    EEG_CHANNELS,
 )
 
+# ターゲット番号の読み込みは血流解析と共通のものを使う
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "blood_analyze")
+)
+from blood_pipeline import read_analyze_info, get_target_numbers
+
 POLYMATE_SAMPLING = 0.025
 INTERVAL = 3  # 刺激提示間隔
 ANALYZE_START = 0.2  # 刺激提示の0.2秒前から解析する
@@ -38,30 +50,12 @@ HIDDEN_TIME = 2.7
 
 LED = False  # LEDを繰り返したか
 
+RESAMPLE = True  # Falseなら補間せずにサンプル点をそのまま切り出す
+EPOCH_MARGIN = 4  # 秋間補間に使う解析区間外のサンプル数
 
-def get_target_numbers(analyze_info):
-    """
-    Analyze_infoデータフレームから目標値(target number)のリストを取得します。
-
-    Args:
-        analyze_info (DataFrame): 分析情報が含まれるPandasのデータフレーム。
-
-    Returns:
-        List[List[float]]: 目標値のリストのリスト。各サブリストは一つの実験データに対応します。
-    """
-    target_rows = analyze_info[analyze_info[0].str.contains("target number")]
-    target_numbers = target_rows.iloc[:, 1:].values.tolist()
-
-    for i in range(len(target_numbers)):
-        target_numbers[i] = [num for num in target_numbers[i]]
-
-    target_numbers = [list(row) for row in zip(*target_numbers)]
-
-    target_numbers = [
-        [x for x in sublist if not math.isnan(x)] for sublist in target_numbers
-    ]
-
-    return target_numbers
+# Trueならアーチファクトを含むエポックを加算から除外する
+# 元のeeg_csvを直接読むので、artifact_remove.pyの実行は不要
+REJECT_EPOCHS = False
 
 
 def make_target_numbers(data_dir_path):
@@ -69,9 +63,7 @@ def make_target_numbers(data_dir_path):
     if not os.path.isfile(summary_path):
         print("blood_excelディレクトリにsummary.xlsxがないです")
         return
-    analyze_info = pd.read_excel(
-        summary_path, sheet_name="analyze_info", header=None, engine="openpyxl"
-    )
+    analyze_info = read_analyze_info(summary_path)
     target_numbers = get_target_numbers(analyze_info)  # 2次元リスト
 
     return target_numbers
@@ -111,6 +103,46 @@ def getSplineFunc(data):
     return f
 
 
+def getEpoch(data, target_time):
+    """
+    ターゲット付近の脳波データを切り出します。
+    秋間補間はある区間の値が前後3点のデータだけで決まるため、
+    ファイル全体ではなく解析区間の前後EPOCH_MARGIN点だけで補間関数を作ります。
+
+    Args:
+        data (numpy.ndarray): 1ファイル分の脳波データ
+        target_time (float): ターゲットの時間
+
+    Returns:
+        numpy.ndarray: ターゲットの時間を基準にした脳波データ。
+                       RESAMPLEがTrueならPOINT点に補間し、Falseならサンプル点をそのまま返す
+    """
+    start_time = target_time - ANALYZE_START
+    end_time = target_time + INTERVAL
+
+    if not RESAMPLE:
+        start = int(round(start_time / POLYMATE_SAMPLING))
+        length = int(round((ANALYZE_START + INTERVAL) / POLYMATE_SAMPLING)) + 1
+        if start < 0 or start + length > len(data):
+            return None
+        return np.asarray(data[start : start + length], dtype=float)
+
+    start = max(int(math.floor(start_time / POLYMATE_SAMPLING)) - EPOCH_MARGIN, 0)
+    end = min(
+        int(math.ceil(end_time / POLYMATE_SAMPLING)) + EPOCH_MARGIN + 1, len(data)
+    )
+
+    target_t = np.linspace(start_time, end_time, num=POINT)
+    if end - start < 2:
+        # データの範囲外(ファイル全体で補間した場合と同じくnanになる)
+        return np.full(POINT, np.nan)
+
+    x = np.arange(start, end) * POLYMATE_SAMPLING
+    f = interpolate.Akima1DInterpolator(x, data[start:end])
+
+    return f(target_t)
+
+
 def getTargetTime(oddstart_time, target):
     """
     特定のターゲットの時間を計算します。
@@ -127,6 +159,29 @@ def getTargetTime(oddstart_time, target):
     return target_time
 
 
+def getRejectedTargets(mask, target_times):
+    """
+    解析区間にアーチファクトを含むターゲットを調べます。
+    マスクの累積和を使い、全ターゲットの区間内のアーチファクト数をまとめて求めます。
+
+    Args:
+        mask (numpy.ndarray): サンプルごとのアーチファクトマスク(1次元のbool配列)
+        target_times (list): ターゲットの時間のリスト
+
+    Returns:
+        numpy.ndarray: 除外するターゲットがTrueとなるbool配列
+    """
+    target_times = np.asarray(target_times, dtype=float)
+    artifact_count = np.concatenate(([0], np.cumsum(mask)))
+
+    start = np.floor((target_times - ANALYZE_START) / POLYMATE_SAMPLING).astype(int)
+    end = np.ceil((target_times + INTERVAL) / POLYMATE_SAMPLING).astype(int) + 1
+    start = np.clip(start, 0, len(mask))
+    end = np.clip(end, 0, len(mask))
+
+    return artifact_count[end] - artifact_count[start] > 0
+
+
 def readData(data_ws):
     """
     ExcelファイルからEEGデータを読み込みます。
@@ -163,14 +218,15 @@ def readTarget(target_ws):
     return targetlist
 
 
-def displayGraph(target_eeg_total):
+def displayGraph(target_eeg_total, graph_path=None):
     """
     処理されたEEGデータのグラフを表示します。
 
     Args:
         target_eeg_total (numpy.ndarray): 加算されたEEGデータ
+        graph_path (str): 指定した場合、表示せずにこのパスへ画像として保存します
     """
-    t = np.linspace(-ANALYZE_START, 3, num=POINT)
+    t = np.linspace(-ANALYZE_START, INTERVAL, num=len(target_eeg_total))
 
     fig, ax = plt.subplots()
     ax.invert_yaxis()
@@ -180,45 +236,114 @@ def displayGraph(target_eeg_total):
     ax.plot(t, target_eeg_total, label="eeg", color="black")
     ax.grid()
 
-    plt.show()
+    if graph_path:
+        fig.savefig(graph_path)
+        plt.close(fig)
+    else:
+        plt.show()
 
 
-def main():
-    setting_file = get_setting_file_path()
-    data_dir_name = read_dir_name_from_settings(setting_file)
+def addFileEpochs(file, targets, oddstart_time):
+    """
+    1ファイル分のターゲット付近の脳波データを切り出して加算します。
+
+    Args:
+        file (str): 脳波データのCSVファイル
+        targets (list): ターゲットの番号のリスト
+        oddstart_time (float): オッドボール課題の開始時間
+
+    Returns:
+        tuple: (加算した脳波データ(加算できるものが無ければNone), 加算した数, アーチファクトで除外した数)
+    """
+    data_df = pd.read_csv(file, usecols=lambda c: c == " 1-REF" or c in EEG_CHANNELS)
+    data = data_df[" 1-REF"].to_numpy()
+
+    target_times = [getTargetTime(oddstart_time, target) for target in targets]
+
+    if REJECT_EPOCHS:
+        mask = make_artifact_mask(data_df[EEG_CHANNELS].to_numpy(dtype=float))
+        rejected = getRejectedTargets(mask.any(axis=1), target_times)
+    else:
+        rejected = np.zeros(len(target_times), dtype=bool)
+
+    eeg_sum = None
+    added = 0
+    for target, target_time, is_rejected in zip(targets, target_times, rejected):
+        if is_rejected:
+            continue
+        epoch = getEpoch(data, target_time)
+        if epoch is None:
+            print("解析区間がデータの範囲外のためスキップ：", file, target)
+            continue
+        eeg_sum = epoch if eeg_sum is None else eeg_sum + epoch
+        added += 1
+
+    return eeg_sum, added, int(np.count_nonzero(rejected))
+
+
+def main(jobs=1, data_dir_name=None, graph_path=None):
+    # data_dir_nameが指定されていなければanalyze_setting.txtから読み込む
+    if data_dir_name is None:
+        setting_file = get_setting_file_path()
+        data_dir_name = read_dir_name_from_settings(setting_file)
     data_dir_path = get_data_dir_path(data_dir_name)
 
-    csv_dir_path = os.path.join(data_dir_path, "eeg_csv", "artifact_removed")
-    csv_files = glob.glob(csv_dir_path + "/*.csv")
+    if REJECT_EPOCHS:
+        csv_dir_path = os.path.join(data_dir_path, "eeg_csv")
+    else:
+        csv_dir_path = os.path.join(data_dir_path, "eeg_csv", "artifact_removed")
+    # analyze_infoの列(セッション)と同じ順になるように、ファイル名順に並べる
+    csv_files = sorted(glob.glob(csv_dir_path + "/*.csv"))
 
     # target_numbersを取得
     target_numbers = make_target_numbers(data_dir_path)  # 二次元リスト
+    if target_numbers is None:
+        return False
+    if len(csv_files) != len(target_numbers):
+        print(
+            f"CSVファイル数({len(csv_files)})とanalyze_infoのtarget numberの列数"
+            f"({len(target_numbers)})が一致していません"
+        )
+        return False
 
     oddstart_time = getOddballStartTime()
-    target_eeg = []
-
-    for i, file in enumerate(csv_files):
-        data = pd.read_csv(file, usecols=[" 1-REF"], squeeze=True)
-        data_list = data.tolist()
 
-        for target in target_numbers[i]:
-            target_time = getTargetTime(oddstart_time, target)
-            data_spline_func = getSplineFunc(data_list)
-            target_t = np.linspace(
-                target_time - ANALYZE_START, target_time + INTERVAL, num=POINT
-            )
-            target_eeg.append(data_spline_func(target_t))
+    # ファイルごとに加算し(--jobsが2以上なら並列に処理)、最後に全ファイル分を合計する
+    results = map_files(
+        addFileEpochs,
+        jobs,
+        csv_files,
+        target_numbers,
+        [oddstart_time] * len(csv_files),
+    )
 
-    target_eeg_arr = np.array(target_eeg)
-    target_eeg_total = np.sum(target_eeg_arr, axis=0)
+    target_eeg_total = None
+    added_total = 0
+    for file, (eeg_sum, added, rejected) in zip(csv_files, results):
+        if REJECT_EPOCHS:
+            print(os.path.basename(file), "採用：", added, "除外：", rejected)
+        if eeg_sum is None:
+            continue
+        if target_eeg_total is None:
+            target_eeg_total = eeg_sum
+        else:
+            target_eeg_total = target_eeg_total + eeg_sum
+        added_total += added
+
+    if target_eeg_total is None:
+        print("加算できるターゲットがありません")
+        return False
 
     print(np.max(target_eeg_total))
     print(np.min(target_eeg_total))
 
     print("ターゲットの総数：", sum(len(sublist) for sublist in target_numbers))
+    if REJECT_EPOCHS:
+        print("加算したターゲットの数：", added_total)
 
-    displayGraph(target_eeg_total)
+    displayGraph(target_eeg_total, graph_path)
+    return True
 
 
 if __name__ == "__main__":
-    main()
+    main(parse_args().jobs)
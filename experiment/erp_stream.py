@@ -0,0 +1,223 @@
+"""
+オッドボール課題の実行中に脳波を読み込み、ターゲット(red)と標準刺激(green)ごとにERPを加算平均する
+odball.pyのSTREAM_ERPをTrueにすると使われる
+
+脳波の読み込み元---
+・脳波計のソフトが追記していくcsvファイル(EEG_CHANNELの列を読む)
+・"localhost:5000"のような文字列を指定すると、ローカルのソケットから1行に1サンプルの数値を受け取る
+どちらも読み込みを始めた時点をサンプル0とし、サンプル番号 × EEG_SAMPLING を刺激提示の時刻と対応させる
+"""
+
+import socket
+import time
+import tkinter as tk
+import numpy as np
+
+EEG_SAMPLING = 0.025  # 脳波のサンプリング周期[s] (eeg_add.pyのPOLYMATE_SAMPLING)
+EEG_CHANNEL = " 1-REF"  # csvから読み込む列名
+ANALYZE_START = 0.2  # 刺激提示の0.2秒前から加算する
+INTERVAL = 3  # 刺激提示から3秒後まで加算する
+
+STIMULUS_KINDS = ["target", "standard"]
+LINE_COLORS = {"target": "red", "standard": "green"}
+
+
+class FileSource:
+    """追記されていくcsvファイルから、読み込み開始後に追加された行だけを読む"""
+
+    def __init__(self, path, channel=EEG_CHANNEL):
+        self.file = open(path, "r", encoding="utf-8", errors="ignore")
+        self.channel = channel
+        self.column = None
+        self.rest = ""
+
+        # 既にある行は読み飛ばす(ヘッダーがあれば列番号だけ調べる)
+        for line in self.file:
+            self.find_column(line)
+
+    def find_column(self, line):
+        names = line.rstrip("\r\n").split(",")
+        if self.channel in names:
+            self.column = names.index(self.channel)
+
+    def read(self):
+        """前回からの新しいサンプルを配列で返す"""
+        text = self.rest + self.file.read()
+        lines = text.split("\n")
+        self.rest = lines.pop()  # 書き込み途中の行は次回に回す
+
+        samples = []
+        for line in lines:
+            if self.column is None:
+                self.find_column(line)
+                continue
+            values = line.rstrip("\r").split(",")
+            try:
+                samples.append(float(values[self.column]))
+            except (IndexError, ValueError):
+                self.find_column(line)
+        return np.array(samples, dtype=float)
+
+    def close(self):
+        self.file.close()
+
+
+class SocketSource:
+    """ローカルのソケットから、1行に1サンプルの数値を受け取る(脳波計の代わり)"""
+
+    def __init__(self, address):
+        host, port = address.rsplit(":", 1)
+        self.sock = socket.create_connection((host, int(port)))
+        self.sock.setblocking(False)
+        self.rest = b""
+
+    def read(self):
+        """前回からの新しいサンプルを配列で返す"""
+        data = self.rest
+        while True:
+            try:
+                chunk = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+
+        lines = data.split(b"\n")
+        self.rest = lines.pop()
+        return np.array([float(line) for line in lines if line.strip()], dtype=float)
+
+    def close(self):
+        self.sock.close()
+
+
+def open_source(source):
+    """ファイルのパスまたは"ホスト:ポート"から読み込み元を作る"""
+    host, _, port = source.rpartition(":")
+    if host and port.isdigit():
+        return SocketSource(source)
+    return FileSource(source)
+
+
+class StreamingERP:
+    """
+    刺激ごとのエポックを、データが揃いしだい刺激の種類ごとに足し込みます。
+    全データを保存しないので、長いセッションでも使うメモリは一定です。
+
+    Args:
+        source: read()で新しいサンプルの配列を返す読み込み元。
+        start_time (float): サンプル0に対応するtime.perf_counter()の値。省略すると今の時刻。
+    """
+
+    def __init__(self, source, start_time=None):
+        self.source = source
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.pre = int(round(ANALYZE_START / EEG_SAMPLING))
+        self.length = self.pre + int(round(INTERVAL / EEG_SAMPLING)) + 1
+        self.times = (np.arange(self.length) - self.pre) * EEG_SAMPLING
+
+        self.buffer = np.empty(0)
+        self.buffer_start = 0  # bufferの先頭のサンプル番号
+        self.pending = []  # (エポック先頭のサンプル番号, 刺激の種類)
+        self.sums = {kind: np.zeros(self.length) for kind in STIMULUS_KINDS}
+        self.counts = {kind: 0 for kind in STIMULUS_KINDS}
+        # 先頭のデータが既に無く、加算できなかったエポックの数
+        self.dropped = {kind: 0 for kind in STIMULUS_KINDS}
+
+    def add_stimulus(self, kind, onset=None):
+        """刺激の提示を記録する。onsetはtime.perf_counter()の値(省略すると今の時刻)"""
+        if onset is None:
+            onset = time.perf_counter()
+        onset_sample = int(round((onset - self.start_time) / EEG_SAMPLING))
+        self.pending.append((onset_sample - self.pre, kind))
+
+    def update(self):
+        """
+        新しいサンプルを読み込み、データが揃ったエポックを加算します。
+
+        Returns:
+            int: 今回加算したエポックの数。
+        """
+        self.buffer = np.concatenate([self.buffer, self.source.read()])
+        buffer_end = self.buffer_start + len(self.buffer)
+
+        added = 0
+        waiting = []
+        for start, kind in self.pending:
+            if start + self.length > buffer_end:
+                waiting.append((start, kind))
+                continue
+            if start < self.buffer_start:
+                # エポックの先頭のサンプルを既に捨てていた(読み込み開始の直後の刺激など)
+                self.dropped[kind] += 1
+                print(f"ERP: {kind}のエポックの先頭のデータが無いので加算しません")
+                continue
+            offset = start - self.buffer_start
+            self.sums[kind] += self.buffer[offset : offset + self.length]
+            self.counts[kind] += 1
+            added += 1
+        self.pending = waiting
+
+        # まだ加算していないエポックより前のサンプルは捨てる
+        # 次に登録される刺激の提示前(ANALYZE_START)の分は、待っているエポックが無くても残しておく
+        pending_starts = [start for start, _ in self.pending]
+        keep_from = min(pending_starts + [buffer_end - self.pre])
+        keep_from = max(keep_from - self.buffer_start, 0)
+        self.buffer = self.buffer[keep_from:]
+        self.buffer_start += keep_from
+
+        return added
+
+    def mean(self, kind):
+        """刺激の種類ごとの加算平均。まだ加算していなければNone"""
+        if self.counts[kind] == 0:
+            return None
+        return self.sums[kind] / self.counts[kind]
+
+    def close(self):
+        self.source.close()
+
+
+class ERPView:
+    """StreamingERPの加算平均を別ウィンドウに線で表示する"""
+
+    def __init__(self, root, erp, width=600, height=300):
+        self.erp = erp
+        self.width = width
+        self.height = height
+        self.window = tk.Toplevel(root)
+        self.window.title("ERP")
+        self.canvas = tk.Canvas(self.window, width=width, height=height, bg="white")
+        self.canvas.pack()
+        self.label = tk.Label(self.window, text="")
+        self.label.pack()
+
+    def draw(self):
+        self.canvas.delete("all")
+
+        means = {kind: self.erp.mean(kind) for kind in STIMULUS_KINDS}
+        drawn = [mean for mean in means.values() if mean is not None]
+        if drawn:
+            low = min(np.min(mean) for mean in drawn)
+            high = max(np.max(mean) for mean in drawn)
+            scale = (self.height - 20) / (high - low) if high > low else 1
+            x = np.linspace(0, self.width, self.erp.length)
+
+            # 刺激提示の時刻に縦線を引く
+            onset_x = self.erp.pre / (self.erp.length - 1) * self.width
+            self.canvas.create_line(onset_x, 0, onset_x, self.height, fill="gray")
+
+            for kind, mean in means.items():
+                if mean is None:
+                    continue
+                y = self.height - 10 - (mean - low) * scale
+                points = np.column_stack([x, y]).ravel().tolist()
+                self.canvas.create_line(*points, fill=LINE_COLORS[kind])
+
+        texts = []
+        for kind in STIMULUS_KINDS:
+            text = f"{kind}: {self.erp.counts[kind]}"
+            if self.erp.dropped[kind]:
+                text += f" (dropped {self.erp.dropped[kind]})"
+            texts.append(text)
+        self.label.config(text="  ".join(texts))
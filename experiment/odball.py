@@ -5,48 +5,258 @@
 ・刺激提示の秒数を0.5秒→0.3秒に
 ・ターゲット（低頻度刺激）を数えさせるのではなく、表示中にボタンを押させる
 logファイルはtargetlog.log
+刺激の提示時刻とキー入力はevents_日時.jsonl(EVENT_LOG_FORMATが"csv"なら.csv)にも記録する
 """
 
 # 刺激提示間隔3s
+import datetime
+import json
+import os
+import queue
 import random
 import time
-import serial
 import tkinter as tk
 import logging
+from logging.handlers import QueueHandler, QueueListener
+
+from erp_stream import StreamingERP, ERPView, open_source
+from target_sequence import generate_targets
 
 LED = False  # LEDで外乱を与えたい場合はTrue,そうじゃないならFalse
+SERIAL_PORT = "COM3"  # "mock"ならArduinoを使わず、書き込んだ内容と時刻を記録するだけ
+
+# Trueなら脳波を読み込みながら、ターゲットと標準刺激のERPを加算して別ウィンドウに表示する
+STREAM_ERP = False
+# 脳波の読み込み元。追記されていくcsvファイル、または"localhost:5000"
+EEG_STREAM_SOURCE = "eeg_stream.csv"
+ERP_UPDATE_INTERVAL = 500  # ERPを更新する間隔[ms]
 
 BLINKS = 20  # LED提示回数 20230524 50→20
+LED_ON_TIME = 0.21  # LEDを点灯しておく時間[s]
+LED_OFF_TIME = 0.2  # LEDを消灯しておく時間[s]
 STIMULUS_PRESENTATIONS = 200  # 刺激提示回数
 
+# ターゲットの並びの条件(target_sequence.pyを参照)
+TARGET_SEED = None  # 整数を指定すると、起動後の各セッションの並びを再現できる
+MIN_TARGET_GAP = 2  # 隣り合うターゲットの番号の最小の差(2なら連続しない)
+MAX_STANDARD_RUN = None  # 標準刺激が連続する最大の回数。Noneなら制限なし
+BALANCED_TARGETS = False  # Trueなら前半と後半のターゲット数をそろえる
+
+HIDDEN_TIME = 2.7  # 円を隠しておく時間[s]
+SHOW_TIME = 0.3  # 円を表示する時間[s]
+SPIN_TIME = 0.005  # 予定時刻の直前はroot.afterではなくこの時間だけ待ち続けて合わせる[s]
+
+# 刺激とキー入力のイベントログ。セッションごとにevents_日時.jsonl(または.csv)を作る
+# 時刻(scheduled, actual)はすべてtime.perf_counter()の値[s]
+EVENT_LOG_FORMAT = "jsonl"  # "jsonl"または"csv"
+EVENT_FIELDS = [
+    "event",
+    "index",
+    "type",
+    "scheduled",
+    "actual",
+    "key",
+    "time",
+    "targets",
+]
+LOG_DIR = os.path.dirname(os.path.abspath(__file__))
+
 count = 0
 ns = []  # ターゲットの番号
 enter_count = 0
 circle_state = ""  # 画面上の円の状態 hidden,green,redの3種類
+erp = None  # STREAM_ERPのときのStreamingERP
+# ターゲットの並びを選ぶ乱数。起動時に一度だけ作るので、シードを指定してもセッションごとに並びは変わる
+target_rng = random.Random(TARGET_SEED)
+erp_view = None
+erp_after_id = None
+session_start = 0.0  # セッション開始時のtime.perf_counter()
+onsets = []  # (刺激の番号, 予定の提示時刻, 実際の提示時刻) 時刻はtime.perf_counter()
+event_listener = None  # イベントログをファイルに書き込むQueueListener
 
 logger = logging.getLogger("target")
 logger.setLevel(10)
-fh = logging.FileHandler("C:/python_program/research_program/experiment/targetlog.log")
+fh = logging.FileHandler(os.path.join(LOG_DIR, "targetlog.log"))
 logger.addHandler(fh)
 
 formatter = logging.Formatter("%(asctime)s:%(levelname)s:%(message)s")
 fh.setFormatter(formatter)
 
+# イベントはキューに入れるだけにして、整形と書き込みはQueueListenerのスレッドで行う
+event_queue = queue.SimpleQueue()
+event_logger = logging.getLogger("event")
+event_logger.setLevel(logging.INFO)
+event_logger.propagate = False
+
+
+class EventQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # 同じプロセス内のキューなので、辞書のままListenerに渡す
+        return record
+
+
+class EventFormatter(logging.Formatter):
+    """イベントの辞書を1行のJSONまたはcsvにする"""
+
+    def format(self, record):
+        event = record.msg
+        if EVENT_LOG_FORMAT == "csv":
+            return ",".join(str(event.get(field, "")) for field in EVENT_FIELDS)
+        return json.dumps(event, ensure_ascii=False)
+
+
+event_logger.addHandler(EventQueueHandler(event_queue))
+
+
+def startEventLog():
+    global event_listener
+    stopEventLog()
+
+    now = datetime.datetime.now()
+    path = os.path.join(
+        LOG_DIR, now.strftime("events_%Y%m%d_%H%M%S.") + EVENT_LOG_FORMAT
+    )
+    if EVENT_LOG_FORMAT == "csv":
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(",".join(EVENT_FIELDS) + "\n")
+
+    event_fh = logging.FileHandler(path, encoding="utf-8")
+    event_fh.setFormatter(EventFormatter())
+    event_listener = QueueListener(event_queue, event_fh)
+    event_listener.start()
+
+
+def stopEventLog():
+    """キューに残ったイベントを書き込んでからファイルを閉じる"""
+    global event_listener
+    if event_listener is not None:
+        event_listener.stop()
+        for handler in event_listener.handlers:
+            handler.close()
+        event_listener = None
+
+
+def logEvent(event, **fields):
+    if event_listener is None:
+        # セッション外のイベントは記録しない
+        return
+    fields["event"] = event
+    event_logger.info(
+        {field: fields[field] for field in EVENT_FIELDS if field in fields}
+    )
+
 
 def closePort():
     global ser, root
     if LED:
         ser.close()
+    stopERPUpdates()
+    if erp is not None:
+        erp.close()
+    stopEventLog()
     root.destroy()  # 画面を消す
 
 
-def lightOnOff():
+def updateERP():
+    """ERPを更新して描き直し、ERP_UPDATE_INTERVAL後にまた呼ぶ。ERPのウィンドウが閉じられたらやめる"""
+    global erp, erp_view, erp_after_id
+    erp_after_id = None
+    if not erp_view.window.winfo_exists():
+        return
+    if erp.update():
+        erp_view.draw()
+    erp_after_id = root.after(ERP_UPDATE_INTERVAL, updateERP)
+
+
+def stopERPUpdates():
+    """予約してあるERPの更新を取り消す"""
+    global erp_after_id
+    if erp_after_id is not None:
+        root.after_cancel(erp_after_id)
+        erp_after_id = None
+
+
+class MockSerial:
+    """Arduinoが無くても動作を確かめられるように、書き込んだ内容と時刻を保存するだけのシリアルポート"""
+
+    def __init__(self):
+        self.writes = []  # (time.perf_counter(), 書き込んだバイト列)
+
+    def write(self, data):
+        self.writes.append((time.perf_counter(), data))
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def openSerial():
+    if SERIAL_PORT == "mock":
+        return MockSerial()
+
+    import serial
+
+    return serial.Serial(SERIAL_PORT, 9600)
+
+
+def lightOnOff(step, led_start, on_finished):
+    """
+    LEDの点滅をroot.afterで1段階ずつ進める(画面を止めないようにsleepは使わない)
+    stepが偶数なら点灯、奇数なら消灯し、BLINKS回の点滅が終わったらon_finishedを呼ぶ
+    点灯・消灯の予定時刻はled_startから計算し、実際に書き込んだ時刻をイベントログに残す
+    """
     global ser
-    for i in range(BLINKS):
-        ser.write(b"1")  # Arduino に 1 を送る
-        time.sleep(0.21)
+    blink, off = divmod(step, 2)
+    scheduled = led_start + blink * (LED_ON_TIME + LED_OFF_TIME) + off * LED_ON_TIME
+    if blink == BLINKS:
+        on_finished()
+        return
+
+    if off:
         ser.write(b"0")  # LED を消す
-        time.sleep(0.2)
+    else:
+        ser.write(b"1")  # Arduino に 1 を送る
+    logEvent(
+        "led",
+        index=blink + 1,
+        type="off" if off else "on",
+        scheduled=scheduled,
+        actual=time.perf_counter(),
+    )
+
+    next_time = scheduled + (LED_OFF_TIME if off else LED_ON_TIME)
+    scheduleAt(next_time, lambda: lightOnOff(step + 1, led_start, on_finished))
+
+
+def scheduledOnset(number):
+    """number番目の刺激を提示する予定の時刻(セッション開始からの絶対時刻)"""
+    return session_start + (number - 1) * (HIDDEN_TIME + SHOW_TIME) + HIDDEN_TIME
+
+
+def scheduleAt(target_time, func):
+    """
+    time.perf_counter()がtarget_timeになったときにfuncを実行する
+    待ち時間は毎回予定時刻から計算し直すので、前の処理の遅れは積み重ならない
+    """
+
+    def run():
+        while time.perf_counter() < target_time:
+            pass
+        func()
+
+    delay = int((target_time - time.perf_counter() - SPIN_TIME) * 1000)
+    root.after(max(delay, 0), run)
+
+
+def logOnsetLateness():
+    lateness = [(actual - scheduled) * 1000 for _, scheduled, actual in onsets]
+    if lateness:
+        logger.log(
+            10,
+            "onset lateness mean:%.2fms max:%.2fms",
+            sum(lateness) / len(lateness),
+            max(lateness),
+        )
 
 
 def hidden():
@@ -54,7 +264,15 @@ def hidden():
 
     canvas.itemconfig("oval", state=tk.HIDDEN)
     circle_state = "hidden"
-    root.after(2700, normal)
+    canvas.update_idletasks()
+    logEvent(
+        "stimulus",
+        index=count,
+        type=circle_state,
+        scheduled=scheduledOnset(count) + SHOW_TIME if count else session_start,
+        actual=time.perf_counter(),
+    )
+    scheduleAt(scheduledOnset(count + 1), normal)
 
 
 def normal():
@@ -69,57 +287,123 @@ def normal():
         canvas.itemconfig("oval", state=tk.NORMAL, fill="green")
         circle_state = "green"
 
+    # 画面に反映させてから実際の提示時刻を記録する
+    canvas.update_idletasks()
+    onset = time.perf_counter()
+
     if count <= STIMULUS_PRESENTATIONS:
-        root.after(300, hidden)
+        onsets.append((count, scheduledOnset(count), onset))
+        logEvent(
+            "stimulus",
+            index=count,
+            type=circle_state,
+            scheduled=scheduledOnset(count),
+            actual=onset,
+        )
+        if erp is not None:
+            erp.add_stimulus(
+                "target" if circle_state == "red" else "standard", onset=onset
+            )
+        scheduleAt(scheduledOnset(count) + SHOW_TIME, hidden)
     else:
         count = 0
         label2.config(text=len(ns))  # 20230601 str(ns)→len(ns)
         label4.config(text=enter_count)
 
         logger.log(10, str(ns) + "\n")
+        logOnsetLateness()
+        logEvent("session_end", actual=time.perf_counter())
+        stopEventLog()
+
+        if erp is not None:
+            # 最後の刺激までのエポックを加算してから、ERPの更新を止める
+            stopERPUpdates()
+            if erp.update() and erp_view.window.winfo_exists():
+                erp_view.draw()
 
         enter_count = 0
         ns.clear()
         canvas.itemconfig("oval", state=tk.HIDDEN)
-
-
-def rand_ints_nodup(k):
-    global ns
-    while len(ns) < k:
-        n = random.randint(4, STIMULUS_PRESENTATIONS)
-        if all(
-            num not in ns for num in (n - 1, n, n + 1)
-        ):  # 20230601　値が連続しないように変更
-            ns.append(n)
-    ns.sort()
+        button.config(state=tk.NORMAL)
 
 
 def prepare():
-    global canvas, root, ns, label2
+    global canvas, root, ns, label2, erp, erp_view, erp_after_id
 
-    k = random.randint(
+    # LEDの点滅中も画面は動くので、セッションが終わるまでstartボタンを押せないようにする
+    button.config(state=tk.DISABLED)
+
+    k = target_rng.randint(
         int(STIMULUS_PRESENTATIONS * 0.15), int(STIMULUS_PRESENTATIONS * 0.2)
     )
 
-    rand_ints_nodup(k)
+    # 20230601 値が連続しないように変更 → 条件を満たす並びから直接選ぶ
+    ns[:] = generate_targets(
+        k,
+        STIMULUS_PRESENTATIONS,
+        min_gap=MIN_TARGET_GAP,
+        max_standard_run=MAX_STANDARD_RUN,
+        balanced=BALANCED_TARGETS,
+        rng=target_rng,
+    )
 
     # canvas.create_oval(180, 180, 420, 420, fill="red", tag="oval")
     canvas.create_oval(50, 50, 750, 750, fill="green", tag="oval")  # 20230601 変更
 
+    if STREAM_ERP:
+        stopERPUpdates()
+        if erp is not None:
+            erp.close()
+        erp = StreamingERP(open_source(EEG_STREAM_SOURCE))
+        if erp_view is None or not erp_view.window.winfo_exists():
+            erp_view = ERPView(root, erp)
+        erp_view.erp = erp
+        erp_view.draw()
+        updateERP()
+
+    onsets.clear()
+    startEventLog()
     if LED:
-        lightOnOff()
-
-    hidden()
+        # 点滅が終わってからオッドボール課題を始める
+        led_start = time.perf_counter()
+        logEvent(
+            "led_start",
+            actual=led_start,
+            time=datetime.datetime.now().isoformat(timespec="milliseconds"),
+        )
+        lightOnOff(0, led_start, startSession)
+    else:
+        startSession()
 
     label2.config(text="")
     label4.config(text="")
 
 
+def startSession():
+    global session_start
+    session_start = time.perf_counter()
+    logEvent(
+        "session_start",
+        actual=session_start,
+        time=datetime.datetime.now().isoformat(timespec="milliseconds"),
+        targets=" ".join(str(n) for n in ns),  # ターゲットの番号(空白区切り)
+    )
+    hidden()
+
+
 def count_enter_key(event):
     global enter_count, circle_state
+    pressed = time.perf_counter()
     if event.keysym == "Return":
         enter_count += 1
     logger.log(20, "enter pressed. circle:%s", circle_state)
+    logEvent(
+        "key",
+        index=count,
+        type=circle_state,
+        actual=pressed,
+        key=event.keysym,
+    )
 
 
 # 画面構築
@@ -128,7 +412,7 @@ root.title("circle")
 root.geometry("100x100")  # 画面サイズは 1920x1080
 
 if LED:
-    ser = serial.Serial("COM3", 9600)
+    ser = openSerial()
 
 canvas = tk.Canvas(
     root,
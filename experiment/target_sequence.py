@@ -0,0 +1,226 @@
+"""
+オッドボール課題のターゲット(低頻度刺激)の番号の並びを作る
+odball.pyのrand_ints_nodupの代わり
+
+条件を満たす並びの数を後ろから数えた表を作り、その数に比例した確率で前から1つずつ位置を選ぶので、
+やり直し(棄却)なしで、条件を満たす全ての並びから一様に選べる
+条件---
+・ターゲットはfirst番目からpresentations番目の刺激の中に置く
+・隣り合うターゲットの番号はmin_gap以上離す(2なら連続しない)
+・標準刺激が連続する回数をmax_standard_run以下にする(Noneなら制限なし)
+・balancedがTrueなら、前半と後半のターゲット数をそろえる(奇数なら後半が1つ多い)
+
+実行方法---
+python target_sequence.py --count 100 --seed 0 --output target_sequences.csv
+研究で使う並びを、シードを指定してまとめて作っておける
+"""
+
+import argparse
+import csv
+import random
+
+STIMULUS_PRESENTATIONS = 200  # 刺激提示回数
+FIRST_TARGET = 4  # 最初のターゲットになりうる番号
+TARGET_RATIO = (0.15, 0.2)  # ターゲット数の刺激提示回数に対する割合の範囲
+
+
+def make_count_table(
+    k,
+    presentations=STIMULUS_PRESENTATIONS,
+    first=FIRST_TARGET,
+    min_gap=2,
+    max_standard_run=None,
+    balanced=False,
+):
+    """
+    counts[i][p]: i番目(0から)のターゲットを番号pに置いたとき、残りのターゲットの置き方の数
+
+    Returns:
+        List[List[int]]: 大きな数になるのでPythonのintで数える。
+    """
+    max_gap = presentations if max_standard_run is None else max_standard_run + 1
+    half = presentations // 2
+
+    def allowed(i, p):
+        if balanced:
+            # 前半(half番目まで)にk // 2個、後半に残りを置く
+            return p <= half if i < k // 2 else p > half
+        return True
+
+    counts = [[0] * (presentations + 2) for _ in range(k)]
+    for p in range(first, presentations + 1):
+        # 最後のターゲットの後に続く標準刺激の数
+        if allowed(k - 1, p) and presentations - p < max_gap:
+            counts[k - 1][p] = 1
+
+    for i in range(k - 2, -1, -1):
+        # next_sums[q] = counts[i + 1][q] + counts[i + 1][q + 1] + ... (累積和で区間の和を求める)
+        next_sums = [0] * (presentations + 3)
+        for q in range(presentations, -1, -1):
+            next_sums[q] = next_sums[q + 1] + counts[i + 1][q]
+        for p in range(first, presentations + 1):
+            if not allowed(i, p):
+                continue
+            low = p + min_gap
+            high = min(p + max_gap, presentations)
+            if low <= high:
+                counts[i][p] = next_sums[low] - next_sums[high + 1]
+
+    return counts
+
+
+def sample_targets(counts, rng, presentations, first, min_gap, max_standard_run):
+    """make_count_tableの表から、ターゲットの番号の並びを1つ一様に選ぶ"""
+    max_gap = presentations if max_standard_run is None else max_standard_run + 1
+
+    # 最初のターゲットの前にも標準刺激が続くので、その数も制限する
+    candidates = range(first, min(max_gap, presentations) + 1)
+    targets = []
+    for row in counts:
+        weights = [row[p] for p in candidates]
+        total = sum(weights)
+        if total == 0:
+            raise ValueError("条件を満たすターゲットの並びがありません")
+
+        r = rng.randrange(total)
+        for p, weight in zip(candidates, weights):
+            if r < weight:
+                break
+            r -= weight
+        targets.append(p)
+        candidates = range(p + min_gap, min(p + max_gap, presentations) + 1)
+
+    return targets
+
+
+def generate_targets(
+    k,
+    presentations=STIMULUS_PRESENTATIONS,
+    first=FIRST_TARGET,
+    min_gap=2,
+    max_standard_run=None,
+    balanced=False,
+    rng=None,
+):
+    """
+    条件を満たすk個のターゲットの番号(昇順)を返します。
+
+    Args:
+        k (int): ターゲット数。
+        presentations (int): 刺激提示回数。
+        first (int): 最初のターゲットになりうる番号。
+        min_gap (int): 隣り合うターゲットの番号の最小の差。
+        max_standard_run (int): 標準刺激が連続する最大の回数。Noneなら制限なし。
+        balanced (bool): Trueなら前半と後半のターゲット数をそろえる。
+        rng (random.Random): 乱数生成器。シードを指定したrandom.Randomを渡すと同じ並びになる。
+
+    Returns:
+        List[int]: ターゲットの番号のリスト。
+    """
+    if rng is None:
+        rng = random.Random()
+    if k == 0:
+        return []
+
+    counts = make_count_table(
+        k, presentations, first, min_gap, max_standard_run, balanced
+    )
+    return sample_targets(counts, rng, presentations, first, min_gap, max_standard_run)
+
+
+def check_targets(
+    targets,
+    presentations=STIMULUS_PRESENTATIONS,
+    first=FIRST_TARGET,
+    min_gap=2,
+    max_standard_run=None,
+    balanced=False,
+):
+    """ターゲットの番号の並びが条件を満たしていればTrueを返す"""
+    if not targets:
+        return True
+    if targets[0] < first or targets[-1] > presentations:
+        return False
+    if any(b - a < min_gap for a, b in zip(targets, targets[1:])):
+        return False
+    if max_standard_run is not None:
+        runs = [targets[0] - 1, presentations - targets[-1]]
+        runs += [b - a - 1 for a, b in zip(targets, targets[1:])]
+        if max(runs) > max_standard_run:
+            return False
+    if balanced:
+        if sum(p <= presentations // 2 for p in targets) != len(targets) // 2:
+            return False
+    return True
+
+
+def generate_target_sets(count, presentations=STIMULUS_PRESENTATIONS, seed=None, **kw):
+    """
+    count個のセッション分のターゲットの並びを作ります。
+    ターゲット数はTARGET_RATIOの範囲から選び、同じターゲット数の表は使い回します。
+
+    Returns:
+        List[List[int]]: セッションごとのターゲットの番号のリスト。
+    """
+    rng = random.Random(seed)
+    first = kw.get("first", FIRST_TARGET)
+    min_gap = kw.get("min_gap", 2)
+    max_standard_run = kw.get("max_standard_run")
+
+    tables = {}
+    target_sets = []
+    for _ in range(count):
+        k = rng.randint(
+            int(presentations * TARGET_RATIO[0]), int(presentations * TARGET_RATIO[1])
+        )
+        if k == 0:
+            target_sets.append([])
+            continue
+        if k not in tables:
+            tables[k] = make_count_table(k, presentations, **kw)
+        target_sets.append(
+            sample_targets(
+                tables[k], rng, presentations, first, min_gap, max_standard_run
+            )
+        )
+
+    return target_sets
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100, help="作るセッション数")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--presentations", type=int, default=STIMULUS_PRESENTATIONS)
+    parser.add_argument("--min-gap", type=int, default=2)
+    parser.add_argument("--max-standard-run", type=int, default=None)
+    parser.add_argument("--balanced", action="store_true")
+    parser.add_argument("--output", default="target_sequences.csv")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    conditions = {
+        "min_gap": args.min_gap,
+        "max_standard_run": args.max_standard_run,
+        "balanced": args.balanced,
+    }
+
+    target_sets = generate_target_sets(
+        args.count, args.presentations, seed=args.seed, **conditions
+    )
+
+    with open(args.output, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["session", "targets"])
+        for i, targets in enumerate(target_sets, start=1):
+            if not check_targets(targets, args.presentations, **conditions):
+                raise ValueError("条件を満たさない並びが作られました")
+            writer.writerow([i, " ".join(str(p) for p in targets)])
+
+    print(len(target_sets), "セッション分の並びを書き出しました：", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,497 @@
+"""
+odball.pyのログから、セッションごとのヒット・見逃し・誤反応(false alarm)と反応時間を求める
+
+読み込むログ---
+・events_日時.jsonl(.csv) odball.pyが書き出すイベントログ。1ファイルが1セッション
+  刺激の実際の提示時刻とキー入力の時刻(time.perf_counter())がそのまま使えるので、こちらを優先する
+・targetlog.log イベントログが無い古いセッション用
+  "enter pressed. circle:red" キーが押された時刻と、そのときの円の状態
+  "[11, 15, ...]" セッションの最後に書かれるターゲットの番号のリスト
+  ターゲットのリストが出るまでのキー入力を1セッションとする
+  刺激の提示時刻はログに無いので、リストが書かれた時刻(presentations+1番目の提示時刻)から逆算する
+  刺激数は--presentations(既定はSTIMULUS_PRESENTATIONS)か、セッションの対応表のpresentations
+  root.afterで刺激を出していた頃の周期は3秒より少し長く、セッションごとに違うので、
+  赤の表示中に押されたキー入力(どれかのターゲットの表示中なのが確か)から周期の範囲を求め、
+  その中で、ほかのキー入力の円の状態(hiddenとgreen)と最もよく合う周期を使う
+  反応時間は使わないので、判定の結果に合わせて周期を選ぶことにはならない
+  周期が1つに決まらないセッション(赤の表示中の入力が無い、刺激数が違うなど)は判定しない
+
+反応の判定---
+・ターゲットの提示からRESPONSE_MIN~RESPONSE_MAX秒のキー入力を、そのターゲットへの反応とする
+・緑の表示中のキー入力と、どのターゲットの反応時間の範囲にも入らないキー入力は誤反応
+ターゲットごとに最初の反応だけをヒットとし、残りのキー入力は誤反応とする
+
+セッションの対応表---
+--sessions(既定はこのファイルと同じディレクトリのtargetlog_sessions.csv)に、セッションと
+解析するデータの対応を書いておくと、ターゲットごとの表にdata_dirとfileの列が付く
+  session_id,data_dir,file,presentations
+  2023-09-05 12:55:54.080,subA,subA_2_Oxy.csv,200
+session_idは集計に表示される値(targetlog.logはリストが書かれた時刻、イベントログはファイル名)
+fileはdata_dirの血流・脳波のcsvファイル名、presentationsはtargetlog.logの刺激数(省略可)
+
+実行方法---
+python targetlog_analyze.py
+python targetlog_analyze.py events_20230613_101500.jsonl --output targets.csv
+python targetlog_analyze.py targetlog.log --presentations 100 --sessions sessions.csv
+ログを指定しない場合は、このファイルと同じディレクトリのevents_*.jsonl(.csv)、無ければtargetlog.logを読む
+
+出力---
+セッションごとの集計を表示し、ターゲットごとの表(csv)を書き出す
+表のtarget_indexはセッション内で何番目のターゲットか(result.xlsxのdataNtargetJのJ)
+onsetはセッション開始からの提示時刻[s]。判定しなかったセッションはhitとrtが空欄
+"""
+
+import argparse
+import csv
+import datetime
+import glob
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+
+STIMULUS_PRESENTATIONS = 200  # targetlog.logのセッションの刺激数(odball.pyの既定値)
+HIDDEN_TIME = 2.7  # セッション開始から最初の刺激までの時間[s]
+SHOW_TIME = 0.3  # 円を表示する時間[s]
+PERIOD = HIDDEN_TIME + SHOW_TIME  # 刺激の周期の予定値[s]
+# targetlog.logの周期の範囲。root.afterの遅れで長くなる方にだけずれる(これまでのログでは3.011~3.018秒)
+PERIOD_MIN = PERIOD
+PERIOD_MAX = PERIOD * 1.01
+STATE_MARGIN = 0.05  # 円の表示・非表示の処理の遅れとして許す時間[s]
+PERIOD_CANDIDATES = 200  # 赤の表示中の入力から決めた周期の範囲を、何点に分けて円の状態と照らし合わせるか
+
+RESPONSE_MIN = 0.1  # これより速い反応は刺激への反応とみなさない[s]
+RESPONSE_MAX = 1.2  # これより遅い反応は刺激への反応とみなさない[s]
+
+RESPONSE_KEY = "Return"  # odball.pyでenterの回数として数えるキー
+
+LOG_PATTERN = re.compile(r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}):(\w+):(.*)")
+PRESS_PATTERN = re.compile(r"enter pressed\. circle:(\w*)")
+TARGETS_PATTERN = re.compile(r"\[([\d,\s]*)\]")
+
+EVENT_NUMBER_FIELDS = {"index": int, "scheduled": float, "actual": float}
+
+
+def parse_log(lines):
+    """
+    ログの行を1つずつ読み、(時刻, レベル, メッセージ)を順に返すジェネレータ
+    形式の違う行(空行など)は読み飛ばす
+    """
+    for line in lines:
+        match = LOG_PATTERN.match(line.strip())
+        if match is None:
+            continue
+        time = datetime.datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S,%f")
+        yield time, match.group(2), match.group(3)
+
+
+def iter_sessions(records):
+    """
+    parse_logの出力から、セッションを1つずつ辞書で返すジェネレータ
+    辞書のキーは end(終了時刻), targets(ターゲットの番号), presses((時刻, 円の状態)のリスト)
+    最後のリストの後にあるキー入力(終わらなかったセッション)は返さない
+    """
+    presses = []
+    for time, _, message in records:
+        match = PRESS_PATTERN.match(message)
+        if match:
+            presses.append((time, match.group(1)))
+            continue
+
+        match = TARGETS_PATTERN.fullmatch(message.strip())
+        if match:
+            targets = [int(n) for n in match.group(1).split(",") if n.strip()]
+            yield {"end": time, "targets": targets, "presses": presses}
+            presses = []
+
+
+def count_state_mismatches(before_end, states, targets, presentations, period):
+    """
+    周期をperiodとしたときに、キー入力の時刻から分かる円の状態が、ログの状態と合わない回数を返す
+    hiddenなのに円の表示中、greenなのに標準刺激の表示中でない入力を数える(前後STATE_MARGIN秒は許す)
+    """
+    numbers = np.floor(presentations + 1 - before_end / period).astype(int)
+    phases = (presentations + 1 - numbers) * period - before_end
+    showing = (numbers >= 1) & (phases <= SHOW_TIME + STATE_MARGIN)
+    surely_showing = (numbers >= 1) & (phases >= STATE_MARGIN) & (phases < SHOW_TIME)
+    standard = ~np.isin(numbers, targets)
+
+    hidden_mismatch = (states == "hidden") & surely_showing
+    green_mismatch = (states == "green") & ~(showing & standard)
+    return int(np.count_nonzero(hidden_mismatch | green_mismatch))
+
+
+def estimate_period(before_end, states, targets, presentations):
+    """
+    キー入力の円の状態から、targetlog.logのセッションの周期を求める
+    n番目のターゲットの提示は終了の(presentations + 1 - n) × 周期 前なので、赤の表示中の各入力について、
+    どれかのターゲットの表示中(提示からSHOW_TIME+STATE_MARGIN秒以内)になる周期の範囲を求め、全ての入力で重ねる
+    範囲が1つに決まれば、その中でcount_state_mismatchesが最も少ない周期の中央を返す
+
+    Args:
+        before_end (numpy.ndarray): セッション中のキー入力が終了の何秒前か。
+        states (numpy.ndarray): キー入力のときの円の状態。
+        targets (numpy.ndarray): ターゲットの番号。
+        presentations (int): セッションの刺激数。
+
+    Returns:
+        float: 周期。赤の表示中の入力が無い、範囲が無い、複数あるときはNone。
+    """
+    red_before_end = before_end[states == "red"]
+    if len(red_before_end) == 0 or len(targets) == 0:
+        return None
+
+    cycles = presentations + 1 - targets
+    ranges = [(PERIOD_MIN, PERIOD_MAX)]
+    for red in red_before_end:
+        lows = np.maximum(red / cycles, PERIOD_MIN)
+        highs = np.minimum((red + SHOW_TIME + STATE_MARGIN) / cycles, PERIOD_MAX)
+        ranges = [
+            (max(low, new_low), min(high, new_high))
+            for low, high in ranges
+            for new_low, new_high in zip(lows, highs)
+            if max(low, new_low) <= min(high, new_high)
+        ]
+
+    if len(ranges) != 1:
+        return None
+
+    periods = np.linspace(ranges[0][0], ranges[0][1], PERIOD_CANDIDATES)
+    mismatches = np.array(
+        [
+            count_state_mismatches(before_end, states, targets, presentations, period)
+            for period in periods
+        ]
+    )
+    best = periods[mismatches == mismatches.min()]
+    return (best.min() + best.max()) / 2
+
+
+def log_session_timing(session, presentations):
+    """
+    targetlog.logのセッションを、セッション開始からの時刻[s]に直す
+    終了はpresentations+1番目の刺激の提示時刻なので、n番目の刺激は 終了時刻 - (presentations + 1 - n) × 周期
+    周期はestimate_periodで求め、決まらなければonsetsをNoneにする(判定しない)
+    開始より前のキー入力(終わらなかった前のセッションのもの)は除く
+
+    Returns:
+        dict: start(開始時刻), targets, period, onsets(ターゲットの提示時刻), press_times, press_states。
+    """
+    targets = np.array(session["targets"], dtype=int)
+    before_end = np.array(
+        [(session["end"] - time).total_seconds() for time, _ in session["presses"]]
+    )
+    press_states = np.array([state for _, state in session["presses"]])
+
+    in_session = before_end <= presentations * PERIOD_MAX + HIDDEN_TIME
+    period = estimate_period(
+        before_end[in_session], press_states[in_session], targets, presentations
+    )
+
+    duration = presentations * (PERIOD if period is None else period) + HIDDEN_TIME
+    in_session = before_end <= duration
+    return {
+        "start": session["end"] - datetime.timedelta(seconds=duration),
+        "targets": targets,
+        "period": period,
+        "onsets": None if period is None else HIDDEN_TIME + (targets - 1) * period,
+        "press_times": duration - before_end[in_session],
+        "press_states": press_states[in_session],
+    }
+
+
+def read_events(path):
+    """
+    odball.pyのイベントログ(.jsonlまたは.csv)を読み、イベントの辞書のリストを返す
+    csvの空欄は無い項目として扱う
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        if path.endswith(".csv"):
+            rows = [
+                {field: value for field, value in row.items() if value != ""}
+                for row in csv.DictReader(file)
+            ]
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+
+    for row in rows:
+        for field, convert in EVENT_NUMBER_FIELDS.items():
+            if field in row:
+                row[field] = convert(row[field])
+    return rows
+
+
+def event_session_timing(events):
+    """
+    イベントログのセッションを、セッション開始からの時刻[s]に直す
+    session_endの無い(途中で終わった)セッションはNoneを返す
+
+    Returns:
+        dict: start(開始時刻), targets, onsets(ターゲットの実際の提示時刻), press_times, press_states。
+    """
+    kinds = [event["event"] for event in events]
+    if "session_start" not in kinds or "session_end" not in kinds:
+        return None
+
+    session_start = events[kinds.index("session_start")]
+    start = session_start["actual"]
+    targets = np.array(session_start.get("targets", "").split(), dtype=int)
+
+    actual_onsets = {
+        event["index"]: event["actual"] - start
+        for event in events
+        if event["event"] == "stimulus" and event.get("type") in ("red", "green")
+    }
+    presses = [
+        (event["actual"] - start, event.get("type", ""))
+        for event in events
+        if event["event"] == "key" and event.get("key") == RESPONSE_KEY
+    ]
+
+    return {
+        "start": datetime.datetime.fromisoformat(session_start["time"]),
+        "targets": targets,
+        "onsets": np.array([actual_onsets[n] for n in targets]),
+        "press_times": np.array([time for time, _ in presses]),
+        "press_states": np.array([state for _, state in presses]),
+    }
+
+
+def find_responses(press_times, press_states, onsets):
+    """
+    各キー入力が、どのターゲット(0から数えた番号)への反応かを返す。ターゲットへの反応でなければ-1
+    提示からRESPONSE_MIN~RESPONSE_MAX秒の入力を、範囲に入る直前のターゲットへの反応とする
+    緑の表示中の入力は誤反応とする
+    """
+    responses = np.full(len(press_times), -1)
+    if len(onsets) == 0:
+        return responses
+
+    delays = press_times[:, np.newaxis] - onsets[np.newaxis, :]
+    in_window = (delays >= RESPONSE_MIN) & (delays <= RESPONSE_MAX)
+    windowed = np.argmin(np.where(in_window, delays, np.inf), axis=1)
+
+    responding = in_window.any(axis=1) & (press_states != "green")
+    responses[responding] = windowed[responding]
+    return responses
+
+
+def analyze_session(timing, source):
+    """
+    1セッション分のターゲットごとの表と集計を作る
+    提示時刻が分からない(timing["onsets"]がNone)セッションは判定せず、hitとrtを空欄にする
+
+    Args:
+        timing (dict): log_session_timingまたはevent_session_timingの戻り値。
+        source (str): 提示時刻をどこから得たか("events"または"targetlog")。
+
+    Returns:
+        tuple: (ターゲットごとのデータフレーム, 集計の辞書)。
+    """
+    targets = timing["targets"]
+    onsets = timing["onsets"]
+    press_times = timing["press_times"]
+    period = timing.get("period")
+    summary = {
+        "timing": source,
+        "period": None if period is None else round(period, 4),
+        "targets": len(targets),
+        "presses": len(press_times),
+        "hits": None,
+        "misses": None,
+        "false_alarms": None,
+        "rt_mean": None,
+        "rt_sd": None,
+    }
+
+    if onsets is None:
+        print(
+            timing["start"],
+            "ごろのセッションは、赤の表示中のキー入力から周期が決まらないため判定しません",
+            "(刺激数が違う場合は--presentationsかセッションの対応表で指定してください)",
+        )
+        target_df = pd.DataFrame(
+            {
+                "target_index": np.arange(1, len(targets) + 1),
+                "target_number": targets,
+                "onset": np.nan,
+                "hit": pd.array([pd.NA] * len(targets), dtype="boolean"),
+                "rt": np.nan,
+            }
+        )
+        return target_df, summary
+
+    responses = find_responses(press_times, timing["press_states"], onsets)
+
+    hit = np.zeros(len(targets), dtype=bool)
+    rt = np.full(len(targets), np.nan)
+    false_alarms = 0
+    for press_time, response in zip(press_times, responses):
+        if response < 0 or hit[response]:
+            false_alarms += 1
+            continue
+        hit[response] = True
+        rt[response] = press_time - onsets[response]
+
+    target_df = pd.DataFrame(
+        {
+            "target_index": np.arange(1, len(targets) + 1),
+            "target_number": targets,
+            "onset": np.round(onsets, 3),
+            "hit": pd.array(hit, dtype="boolean"),
+            "rt": np.round(rt, 3),
+        }
+    )
+
+    hits = int(np.count_nonzero(hit))
+    summary.update(
+        hits=hits,
+        misses=len(targets) - hits,
+        false_alarms=false_alarms,
+        rt_mean=round(float(np.mean(rt[hit])), 3) if hits else None,
+        rt_sd=round(float(np.std(rt[hit])), 3) if hits else None,
+    )
+    return target_df, summary
+
+
+def read_session_map(path):
+    """
+    セッションの対応表(csv)を読み、session_idをキーとした辞書を返す
+    ファイルが無ければ空の辞書を返す
+
+    Returns:
+        dict: 値はdata_dir, file, presentations(無ければNone)の辞書。
+    """
+    if not os.path.isfile(path):
+        return {}
+
+    map_df = pd.read_csv(path, dtype=str, encoding="utf-8").fillna("")
+    session_map = {}
+    for row in map_df.to_dict("records"):
+        presentations = row.get("presentations", "")
+        session_map[row["session_id"].strip()] = {
+            "data_dir": row.get("data_dir", ""),
+            "file": row.get("file", ""),
+            "presentations": int(presentations) if presentations else None,
+        }
+    return session_map
+
+
+def iter_timings(log_path, presentations, session_map):
+    """
+    ログファイルのセッションを、(session_id, 提示時刻の出どころ, 時刻の辞書)として順に返すジェネレータ
+    session_idはイベントログならファイル名、targetlog.logならリストが書かれた時刻
+    """
+    if log_path.endswith((".jsonl", ".csv")):
+        timing = event_session_timing(read_events(log_path))
+        if timing is None:
+            print("終わっていないセッションなので読み飛ばします：", log_path)
+            return
+        yield os.path.basename(log_path), "events", timing
+        return
+
+    with open(log_path, "r", encoding="utf-8", errors="ignore") as file:
+        for session in iter_sessions(parse_log(file)):
+            session_id = session["end"].isoformat(sep=" ", timespec="milliseconds")
+            mapped = session_map.get(session_id, {}).get("presentations")
+            timing = log_session_timing(session, mapped or presentations)
+            yield session_id, "targetlog", timing
+
+
+def analyze_log(log_paths, presentations=STIMULUS_PRESENTATIONS, session_map=None):
+    """
+    ログファイルの全セッションを解析する
+    session_mapにあるセッションは、ターゲットごとの表にdata_dirとfileを付ける
+
+    Returns:
+        tuple: (全セッションのターゲットごとのデータフレーム, セッションごとの集計のデータフレーム)。
+    """
+    session_map = session_map or {}
+    target_dfs = []
+    summaries = []
+    i = 0
+    for log_path in log_paths:
+        for session_id, source, timing in iter_timings(
+            log_path, presentations, session_map
+        ):
+            i += 1
+            target_df, summary = analyze_session(timing, source)
+            mapped = session_map.get(session_id, {})
+            if not target_df.empty:
+                target_df.insert(0, "session", i)
+                target_df.insert(1, "session_id", session_id)
+                target_df.insert(2, "data_dir", mapped.get("data_dir", ""))
+                target_df.insert(3, "file", mapped.get("file", ""))
+                target_dfs.append(target_df)
+            summaries.append(
+                {
+                    "session": i,
+                    "session_id": session_id,
+                    "data_dir": mapped.get("data_dir", ""),
+                    **summary,
+                }
+            )
+
+    target_table = pd.concat(target_dfs, ignore_index=True) if target_dfs else None
+    return target_table, pd.DataFrame(summaries)
+
+
+def find_log_paths(log_dir):
+    """イベントログがあればそれを、無ければtargetlog.logを返す"""
+    event_paths = sorted(
+        glob.glob(os.path.join(log_dir, "events_*.jsonl"))
+        + glob.glob(os.path.join(log_dir, "events_*.csv"))
+    )
+    return event_paths or [os.path.join(log_dir, "targetlog.log")]
+
+
+def parse_args():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "log_paths",
+        nargs="*",
+        default=find_log_paths(current_dir),
+        help="イベントログ(.jsonl/.csv)またはtargetlog.log",
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join(current_dir, "targetlog_targets.csv"),
+        help="ターゲットごとの表の出力先",
+    )
+    parser.add_argument(
+        "--presentations",
+        type=int,
+        default=STIMULUS_PRESENTATIONS,
+        help="targetlog.logの1セッションの刺激数",
+    )
+    parser.add_argument(
+        "--sessions",
+        default=os.path.join(current_dir, "targetlog_sessions.csv"),
+        help="セッションと解析するデータの対応表(csv)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    target_table, summary_df = analyze_log(
+        args.log_paths, args.presentations, read_session_map(args.sessions)
+    )
+    if summary_df.empty:
+        print("セッションが見つかりません")
+        return
+
+    print(summary_df.to_string(index=False))
+    if target_table is None:
+        print("ターゲットが無いため、ターゲットごとの表は書き出しません")
+        return
+
+    target_table.to_csv(args.output, index=False)
+    print("ターゲットごとの表を書き出しました：", args.output)
+
+
+if __name__ == "__main__":
+    main()